@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+'''
+Generates a synthetic site and measures how fast it's parsed, built and
+served, to catch throughput regressions between commits.
+
+The site is seeded with the pages of 'tags new' and grows to the given
+number of pages, page size, include depth, tag density and assets. The
+suite measures:
+
+  parse     TemplateLanguage.parse throughput of the pages, in MB/s
+  build     wall time of a full build_files, and of one with -j jobs
+  memory    peak Python memory of a full build, with tracemalloc
+  serve     requests per second of the server, from files and from memory
+
+With --save, the results are appended to a json file along with the commit
+and the site parameters. With --compare, they're compared to the last saved
+results for the same parameters.
+
+Usage: python benchmarks/bench_build.py [--pages N] [--save results.json]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import threading
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if sys.version > '3':
+    from io import StringIO
+    from http.client import HTTPConnection
+else:
+    from StringIO import StringIO
+    from httplib import HTTPConnection
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tags import generator, server, tags, utils
+from tags.templatelang import TemplateLanguage, ENGINES
+
+
+PARAGRAPH = """<p>
+  Some plain text that doesn't contain any tags, like the bulk of the text
+  on a real page, with a <a href="/about.html">link</a> here and there.
+</p>
+"""
+
+TAG = """<a href="/{0}"{{% is {0} %}} class="active"{{% endis %}}>{0}</a>
+"""
+
+PARTIAL = """<div class="level{0}">
+{{% include _partials/level{1}.html %}}
+</div>"""
+
+ASSETS = (('css/style{0}.css', ".rule{0} {{color: #{0:06x};}}\n"),
+          ('js/script{0}.js', "var value{0} = {0};\n"),
+          ('img/image{0}.png', None))
+
+
+def make_site(root, pages=50, page_size=8, depth=3, density=4, assets=50,
+              asset_size=16):
+    ''' Writes a site of pages of about page_size KB into root, with density
+    tags per KB, each including a chain of depth partials, and assets static
+    files of about asset_size KB. Returns the total size of the pages. '''
+    for filename, text in generator.NEW_SITE.items():
+        with utils.open_file(os.path.join(root, filename), 'w',
+                             create_dir=True) as afile:
+            afile.write(text)
+
+    # a chain of partials, the last one is the nav of the new site
+    for level in range(depth):
+        if level + 1 < depth:
+            text = PARTIAL.format(level, level + 1)
+        else:
+            text = "{% include _partials/nav.html %}"
+        filename = '_partials/level{0}.html'.format(level)
+        with utils.open_file(os.path.join(root, filename), 'w',
+                             create_dir=True) as afile:
+            afile.write(text)
+
+    total = 0
+    template = generator.NEW_INDEX_STR
+    if depth:
+        template = template.replace('_partials/nav.html',
+                                    '_partials/level0.html')
+    head, tail = template.split('<h1>')
+    for page in range(pages):
+        filename = 'section{0}/page{1}.html'.format(page % 10, page)
+        body = []
+        size = 0
+        while size < page_size * 1024:
+            chunk = PARAGRAPH * 4
+            for tag in range(density):
+                chunk += TAG.format(filename if tag == 0 else 'other.html')
+            body.append(chunk)
+            size += len(chunk)
+        text = head + "".join(body) + '<h1>' + tail
+        with utils.open_file(os.path.join(root, filename), 'w',
+                             create_dir=True) as afile:
+            afile.write(text)
+        total += len(text)
+
+    for asset in range(assets):
+        filename, line = ASSETS[asset % len(ASSETS)]
+        filename = filename.format(asset)
+        with utils.open_file(os.path.join(root, filename), 'wb',
+                             create_dir=True) as afile:
+            if line is None:
+                afile.write(os.urandom(asset_size * 1024))
+            else:
+                text = "".join(line.format(i)
+                               for i in range(asset_size * 1024 // len(line)))
+                afile.write(text.encode('utf-8'))
+    return total
+
+
+def _pages(root):
+    return [filename for filename in utils.walk_folder(
+                        root, utils.compile_pattern('_*/**'))
+            if filename.endswith('.html')]
+
+
+def bench_parse(root, engine, repeat=3):
+    # renders each page with a new TemplateLanguage, so nothing is cached
+    # between runs. Includes are left out, they're measured by the build.
+    contents = []
+    for filename in _pages(root):
+        with open(os.path.join(root, filename), 'rb') as afile:
+            contents.append((filename, afile.read().decode('utf-8')))
+    size = sum(len(content.encode('utf-8')) for filename, content in contents)
+
+    def _is(path, body='', context={}):
+        return body if path == context.get('filename') else ''
+
+    def _include(path, context={}):
+        return ''
+
+    best = None
+    for i in range(repeat):
+        lang = TemplateLanguage(tags={'is': _is, 'include': _include},
+                                engine=engine, reparse=False)
+        start = time.time()
+        for filename, content in contents:
+            lang.parse(content, filename=filename)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return size / 1e6 / max(best, 1e-9)
+
+
+def _clear_caches():
+    tags.lang._templates = utils.LRUCache(tags.lang._templates.maxsize)
+    tags.source_cache = utils.LRUCache(tags.source_cache.maxsize)
+    tags.output_cache = utils.LRUCache(tags.output_cache.maxsize)
+
+
+def _build(root, dest, jobs=1):
+    shutil.rmtree(dest, ignore_errors=True)
+    _clear_caches()
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        start = time.time()
+        generator.build_files(root=root, dest=dest, jobs=jobs,
+                              incremental=False)
+        return time.time() - start
+    finally:
+        sys.stdout = stdout
+
+
+def bench_build(root, dest, jobs=1, repeat=3):
+    return min(_build(root, dest, jobs) for i in range(repeat))
+
+
+def bench_memory(root, dest):
+    # the peak of memory allocated by Python during a serial build
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        _build(root, dest)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class QuietHandler(server.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietPreviewHandler(server.PreviewHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_serve(root, paths, memory=False, clients=4, requests=2000):
+    # clients keep their connection open and request the paths in turn
+    if memory:
+        site = generator.MemorySite(root=root)
+        httpd = server.start_server(root=root, port=0,
+                                    handler=QuietPreviewHandler, site=site)
+    else:
+        httpd = server.start_server(root=root, port=0, handler=QuietHandler)
+    port = httpd.server_address[1]
+    errors = []
+
+    def _client(offset):
+        conn = HTTPConnection('localhost', port)
+        try:
+            for i in range(requests // clients):
+                conn.request('GET', paths[(offset + i) % len(paths)])
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=_client, args=(i,))
+               for i in range(clients)]
+    try:
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        server.stop_server(httpd)
+    if errors:
+        raise RuntimeError("{0} requests failed, first with status {1}".format(
+            len(errors), errors[0]))
+    return (requests // clients) * clients / max(elapsed, 1e-9)
+
+
+def _commit():
+    try:
+        output = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(params, jobs=2, engines=ENGINES, clients=4, requests=2000,
+        repeat=3):
+    root = tempfile.mkdtemp()
+    try:
+        dest = os.path.join(root, '_site')
+        size = make_site(root, **params)
+        results = {'site_mb': size / 1e6}
+        for engine in engines:
+            results['parse_mbps_' + engine] = bench_parse(root, engine,
+                                                          repeat)
+        results['build_s'] = bench_build(root, dest, repeat=repeat)
+        if jobs > 1:
+            results['build_s_j{0}'.format(jobs)] = bench_build(root, dest,
+                                                               jobs, repeat)
+        peak = bench_memory(root, dest)
+        if peak is not None:
+            results['peak_mb'] = peak / 1e6
+        paths = ['/' + filename.replace(os.sep, '/')
+                 for filename in sorted(_pages(root))]
+        results['serve_rps'] = bench_serve(dest, paths, clients=clients,
+                                           requests=requests)
+        results['serve_rps_memory'] = bench_serve(root, paths, memory=True,
+                                                  clients=clients,
+                                                  requests=requests)
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def load_results(path):
+    try:
+        with open(path, 'r') as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return []
+
+
+def compare(results, previous):
+    # times are better when lower, rates when higher
+    lines = []
+    for name in sorted(results):
+        if name == 'site_mb' or not previous.get(name):
+            continue
+        change = 100.0 * (results[name] - previous[name]) / previous[name]
+        lower = name.endswith(('_s', '_mb')) or '_s_' in name
+        better = change < 0 if lower else change > 0
+        lines.append("{0:<24} {1:>12.3f} {2:>12.3f} {3:>+8.1f}%{4}".format(
+            name, previous[name], results[name], change,
+            '' if abs(change) < 5 else (' better' if better else ' WORSE')))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--page-size', type=int, default=8, metavar='KB')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='the number of nested partials in each page')
+    parser.add_argument('--density', type=int, default=4,
+                        help='tags per KB of page')
+    parser.add_argument('--assets', type=int, default=50)
+    parser.add_argument('--asset-size', type=int, default=16, metavar='KB')
+    parser.add_argument('-j', '--jobs', type=int, default=2)
+    parser.add_argument('--engine', action='append', choices=ENGINES,
+                        help='the parsing engines to measure, default all')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='the best of this many runs is kept')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--save', metavar='FILE',
+                        help='append the results to this json file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare to the last results in this json file')
+    args = parser.parse_args()
+
+    params = {'pages': args.pages, 'page_size': args.page_size,
+              'depth': args.depth, 'density': args.density,
+              'assets': args.assets, 'asset_size': args.asset_size}
+    results = run(params, jobs=args.jobs, engines=args.engine or ENGINES,
+                  clients=args.clients, requests=args.requests,
+                  repeat=args.repeat)
+
+    for name in sorted(results):
+        print("{0:<24} {1:>12.3f}".format(name, results[name]))
+
+    if args.compare:
+        previous = [record for record in load_results(args.compare)
+                    if record['params'] == params]
+        if previous:
+            print("\nCompared to {0} ({1}):".format(
+                previous[-1]['commit'], previous[-1]['date']))
+            print("\n".join(compare(results, previous[-1]['results'])))
+        else:
+            print("\nNo results with the same parameters to compare to")
+
+    if args.save:
+        records = load_results(args.save)
+        records.append({'commit': _commit(),
+                        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'python': platform.python_version(),
+                        'params': params,
+                        'results': results})
+        with open(args.save, 'w') as outfile:
+            json.dump(records, outfile, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''
+Compares the pyparsing and scanner parsing engines of TemplateLanguage on
+large generated templates.
+
+The language can have a number of other tags registered before the ones in
+the template, to show how parsing scales with the number of tags. Packrat
+turns on pyparsing's memoization for the pyparsing engine.
+
+Usage: python benchmarks/bench_engines.py [--tags N] [--packrat] 
+                                          [size_in_kb ...]
+'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tags.templatelang import TemplateLanguage, ENGINES
+
+
+PARAGRAPH = """<p class="intro">
+  Some plain text that doesn't contain any tags at all, long enough to make
+  the free text between tags dominate like it does on a real page.
+</p>
+<a href="/"{% is index.html %} class="active"{% endis %}>home</a>
+"""
+
+
+def _is(path, body='', context={}):
+    return body if path == context.get('filename') else ''
+
+
+def _include(path, context={}):
+    return ''
+
+
+def make_template(size):
+    # body-less tags are kept to a handful: the pyparsing grammar tries to
+    # match a body for each of them, which gets exponentially slower
+    paragraphs = max(1, size // len(PARAGRAPH))
+    return "{% include header.html %}\n" + PARAGRAPH * paragraphs
+
+
+def bench(lang, template, repeat=3):
+    best = None
+    for i in range(repeat):
+        lang._templates.clear()
+        start = time.time()
+        lang.parse(template, filename='index.html')
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _other(*args, **kwargs):
+    return ''
+
+
+def main(sizes, tags=0, packrat=False):
+    langs = {}
+    for engine in ENGINES:
+        lang = TemplateLanguage(engine=engine, packrat=packrat)
+        for i in range(tags):
+            lang.add_tag_with_name('other{0}'.format(i))(_other)
+        lang.add_tag_with_name('is')(_is)
+        lang.add_tag_with_name('include')(_include)
+        langs[engine] = lang
+
+    print("{0:>10} {1:>12} {2:>12} {3:>10}".format(
+        "size", "pyparsing", "scanner", "speedup"))
+    for size in sizes:
+        template = make_template(size * 1024)
+        results = dict((engine, bench(lang, template))
+                       for engine, lang in langs.items())
+        assert (langs['pyparsing'].parse(template, filename='index.html') ==
+                langs['scanner'].parse(template, filename='index.html'))
+        print("{0:>8}kb {1:>11.3f}s {2:>11.3f}s {3:>9.1f}x".format(
+            size, results['pyparsing'], results['scanner'],
+            results['pyparsing'] / max(results['scanner'], 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sizes', type=int, nargs='*', default=[16, 64, 256])
+    parser.add_argument('--tags', type=int, default=0,
+                        help='the number of other tags to register')
+    parser.add_argument('--packrat', action='store_true')
+    args = parser.parse_args()
+    main(args.sizes, args.tags, args.packrat)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Compares matching a generated tree of paths against the include and exclude
+patterns, with the old recursive matcher and with compiled patterns.
+
+Usage: python benchmarks/bench_patterns.py [number_of_paths]
+'''
+
+import os
+import sys
+import time
+import fnmatch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tags import utils
+
+
+PATTERN = '**/*.html'
+EXCLUDE = ['_*/**', 'node_modules/**']
+
+
+def recursive_matches_pattern(pattern, filepath):
+    # the matcher utils.matches_pattern used before patterns were compiled
+
+    def _is_match(pattern_list, token_list):
+        if not pattern_list or not token_list:
+            return False
+        i, j = 0, 0
+        while True:
+            if pattern_list[j] == '**':
+                if j+1 == len(pattern_list): return True
+                if _is_match(pattern_list[j+1:], token_list[i:]):
+                    return True
+                else:
+                    i+=1 
+            elif fnmatch.fnmatch(token_list[i], pattern_list[j]):
+                i+=1
+                j+=1
+            else:
+                return False
+            if i==len(token_list) and j==len(pattern_list):
+                return True
+            if i==len(token_list) or j==len(pattern_list):
+                return False
+
+    return _is_match(pattern.strip('/').split('/'), 
+                     filepath.strip('/').split('/'))
+
+
+def make_paths(count):
+    # a site with a few levels of sections, plus partials, the output folder
+    # and a node_modules folder that are all excluded
+    paths = []
+    tops = ['blog', 'docs', 'shop', '_partials', '_site', 'node_modules']
+    i = 0
+    while len(paths) < count:
+        top = tops[i % len(tops)]
+        folder = '/'.join([top] + ['sub{0}'.format(i % d) for d in (7, 5)])
+        ext = ('html', 'css', 'js', 'png')[i % 4]
+        paths.append('{0}/page{1}.{2}'.format(folder, i, ext))
+        i += 1
+    return paths
+
+
+def old_match(paths):
+    results = []
+    for path in paths:
+        excluded = any(recursive_matches_pattern(exclude, path) 
+                       for exclude in EXCLUDE)
+        results.append((recursive_matches_pattern(PATTERN, path), excluded))
+    return results
+
+
+def compiled_match(paths):
+    included = utils.compile_pattern(PATTERN)
+    excluded = utils.compile_pattern(EXCLUDE)
+    return [(included.matches(path), excluded.matches(path)) 
+            for path in paths]
+
+
+def pruned_paths(paths):
+    # the paths a walk never sees, since their folder is excluded entirely
+    excluded = utils.compile_pattern(EXCLUDE)
+    return sum(1 for path in paths 
+               if excluded.matches_folder(path.split('/', 1)[0]))
+
+
+def bench(fn, paths, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn(paths)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(count):
+    paths = make_paths(count)
+    old, old_result = bench(old_match, paths)
+    new, new_result = bench(compiled_match, paths)
+    assert old_result == new_result
+    print("{0} paths: recursive {1:.3f}s, compiled {2:.3f}s, {3:.1f}x".format(
+        count, old, new, old / max(new, 1e-9)))
+    print("{0} of them are in folders the walk doesn't descend into".format(
+        pruned_paths(paths)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+Measures the startup of the tags script: the time to import tags.generator,
+and the wall time of 'tags build' on the site of 'tags new', which is mostly
+startup. Exits with an error when the median build takes longer than the
+budget, so it can run in CI.
+
+Usage: python benchmarks/bench_startup.py [--runs N] [--budget SECONDS]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCRIPT = os.path.join(ROOT, 'scripts', 'tags')
+
+# the median time of a build of the new site, in seconds
+BUDGET = 0.25
+
+
+def _run(args, env):
+    start = time.time()
+    subprocess.check_call([sys.executable] + args, env=env,
+                          stdout=subprocess.PIPE)
+    return time.time() - start
+
+
+def _median(times):
+    times = sorted(times)
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=BUDGET)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+    site = tempfile.mkdtemp()
+    try:
+        _run([SCRIPT, 'new', '-r', site], env)
+        python = [_run(['-c', 'pass'], env) for i in range(args.runs)]
+        imports = [_run(['-c', 'import tags.generator'], env)
+                   for i in range(args.runs)]
+        builds = [_run([SCRIPT, 'build', '-r', site, '--full',
+                        '-o', os.path.join(site, '_site')], env)
+                  for i in range(args.runs)]
+    finally:
+        shutil.rmtree(site)
+
+    print("{0:<24} {1:>9} {2:>9}".format("", "median", "min"))
+    for name, times in (("python", python),
+                        ("import tags.generator", imports),
+                        ("tags build", builds)):
+        print("{0:<24} {1:>8.3f}s {2:>8.3f}s".format(name, _median(times),
+                                                     min(times)))
+
+    if _median(builds) > args.budget:
+        print("tags build took longer than the budget of {0:.3f}s".format(
+            args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,14 @@
 import os
+import re
 from distutils.core import setup
 
 root = os.path.dirname(os.path.realpath(__file__))
+version = re.search(r"__version__ = '(.*)'", 
+                    open(root+"/tags/__init__.py").read()).group(1)
 
 setup(
     name='brace-tags',
-    version='1.0.10',
+    version=version,
     author='Cole Krumbholz, Lauri Hynynen',
     author_email='team@brace.io',
     description='The simplest static site generator',
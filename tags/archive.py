@@ -0,0 +1,128 @@
+'''
+Writes the output of a build into a tar or zip archive instead of a folder.
+
+The destination is a file whose name ends with one of generator.ARCHIVES, or
+'-' for a tar written to stdout. Rendered pages are added from memory and static
+files are streamed from the source folder, so nothing is written to disk but
+the archive itself.
+
+The archives are reproducible: files are added in the order of their names,
+and every entry gets the same owner and modification time, which is
+SOURCE_DATE_EPOCH if it's set in the environment. Building the same source
+twice gives byte for byte the same archive.
+'''
+
+import io
+import os
+import time
+import gzip
+import shutil
+import tarfile
+import zipfile
+
+
+# the earliest time a zip file can record, 1980-01-01
+DEFAULT_EPOCH = 315532800
+
+
+def source_date_epoch():
+    # the modification time of every entry, see reproducible-builds.org
+    try:
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    except (KeyError, ValueError):
+        return DEFAULT_EPOCH
+
+
+def _mode(srcstat):
+    # only the executable bit of a source file is kept
+    if srcstat is not None and srcstat.st_mode & 0o100:
+        return 0o755
+    return 0o644
+
+
+def _arcname(filename):
+    return filename.replace(os.sep, '/')
+
+
+class TarWriter(object):
+    ''' Writes a tar to a stream, compressed according to compression, one
+    of '', 'gz', 'bz2' or 'xz'. The stream needn't be seekable. '''
+
+    def __init__(self, stream, compression='', mtime=None):
+        self.mtime = source_date_epoch() if mtime is None else mtime
+        self._gzip = None
+        if compression == 'gz':
+            # tarfile would record the current time in the gzip header
+            self._gzip = gzip.GzipFile(filename='', mode='wb', fileobj=stream,
+                                       mtime=self.mtime)
+            stream, compression = self._gzip, ''
+        self._tar = tarfile.open(fileobj=stream, mode='w|' + compression,
+                                 format=tarfile.PAX_FORMAT)
+
+    def _info(self, filename, size, srcstat=None):
+        info = tarfile.TarInfo(_arcname(filename))
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = _mode(srcstat)
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        return info
+
+    def add_bytes(self, filename, content):
+        self._tar.addfile(self._info(filename, len(content)),
+                          io.BytesIO(content))
+
+    def add_file(self, filename, path, srcstat=None):
+        srcstat = srcstat or os.stat(path)
+        with open(path, 'rb') as infile:
+            self._tar.addfile(self._info(filename, srcstat.st_size, srcstat),
+                              infile)
+
+    def close(self):
+        self._tar.close()
+        if self._gzip is not None:
+            self._gzip.close()
+
+
+class ZipWriter(object):
+    ''' Writes a deflated zip to a stream, which needn't be seekable. '''
+
+    def __init__(self, stream, mtime=None):
+        self.mtime = source_date_epoch() if mtime is None else mtime
+        self._date_time = time.gmtime(max(self.mtime, DEFAULT_EPOCH))[:6]
+        self._zip = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+
+    def _info(self, filename, size, srcstat=None):
+        info = zipfile.ZipInfo(_arcname(filename), self._date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = (0o100000 | _mode(srcstat)) << 16
+        info.create_system = 3
+        info.file_size = size
+        return info
+
+    def add_bytes(self, filename, content):
+        self._zip.writestr(self._info(filename, len(content)), content)
+
+    def add_file(self, filename, path, srcstat=None):
+        srcstat = srcstat or os.stat(path)
+        info = self._info(filename, srcstat.st_size, srcstat)
+        with open(path, 'rb') as infile:
+            with self._zip.open(info, 'w', force_zip64=(
+                    srcstat.st_size > zipfile.ZIP64_LIMIT)) as outfile:
+                shutil.copyfileobj(infile, outfile, 1 << 16)
+
+    def close(self):
+        self._zip.close()
+
+
+def open_archive(dest, stream):
+    ''' Returns the writer of the archive format that dest names, writing to
+    stream. '''
+    name = dest.lower()
+    if name.endswith('.zip'):
+        return ZipWriter(stream)
+    for ext, compression in (('.tar.gz', 'gz'), ('.tgz', 'gz'),
+                             ('.tar.bz2', 'bz2'), ('.tar.xz', 'xz')):
+        if name.endswith(ext):
+            return TarWriter(stream, compression)
+    return TarWriter(stream)
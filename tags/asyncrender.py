@@ -0,0 +1,115 @@
+'''
+Asynchronous rendering for TemplateLanguage, see parse_async.
+
+This module needs Python 3.7, so it's only imported when a tag function is
+a coroutine function or a template is rendered asynchronously.
+
+The tags of a template are called concurrently, at most limit tag functions
+at a time, and their outputs are joined in order, so the result is the same
+as rendering the template with parse. Each tag is called with its own copy of
+the context, so tags that run concurrently can't see each other's changes to
+the context.
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .profiling import timer
+from .templatelang import (Context, Tag, TemplateText, ParseBaseException,
+                           TagErrorCycle, TagErrorDepth, TagErrorException)
+
+
+def tag_wrapper(lang, name, fn, check):
+    # wraps an async tag function like add_tag_with_name wraps others. Async
+    # tags interleave, so all of their time is counted as self time.
+    async def _wrapper(*args, **kwargs):
+        check(args, kwargs)
+        if lang.profiler is None:
+            return await fn(*args, **kwargs)
+        start = timer()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            lang.profiler.add_tag(name, timer() - start)
+    return _wrapper
+
+
+def run(coroutine):
+    ''' Runs the coroutine of an async tag that's called while rendering
+    synchronously, and returns its result.
+
+    If an event loop is already running in this thread, like when a sync tag
+    renders a template from an async render, the coroutine runs in an event
+    loop of its own in another thread, and this thread waits for it.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(1) as thread:
+        return thread.submit(asyncio.run, coroutine).result()
+
+
+def _branch(context, key):
+    # a copy of the context for a tag, which records the dependencies of the
+    # output in the same place as the original
+    branch = Context(dict.items(context))
+    branch.stack = context.stack + [key]
+    branch._tracking = list(context._tracking)
+    return branch
+
+
+async def render(lang, template, context, limit):
+    ''' Renders a compiled template, calling up to limit tag functions at a
+    time. '''
+    return await _render(lang, template, context, asyncio.Semaphore(limit))
+
+
+async def _render(lang, template, context, semaphore):
+    tags = [segment for segment in template.segments
+            if isinstance(segment, Tag)]
+    if not tags:
+        return "".join(template.segments)
+    results = await asyncio.gather(
+        *[_render_tag(lang, template.source, tag, context, semaphore)
+          for tag in tags],
+        return_exceptions=True)
+    # the error is the one of the first tag that failed, like it would be
+    # when rendering in order
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    outputs = iter(results)
+    return "".join(next(outputs) if isinstance(segment, Tag) else segment
+                   for segment in template.segments)
+
+
+async def _render_tag(lang, parsestr, tag, context, semaphore):
+    fn = lang._tags[tag.name]
+    kwargs = {}
+    if tag.body is not None:
+        if lang._reparse:
+            kwargs['body'] = tag.body
+        else:
+            kwargs['body'] = await _render(lang, lang.compile(tag.body),
+                                           context, semaphore)
+    key = (tag.name, tuple(tag.args), tag.body)
+    context = kwargs['context'] = _branch(context, key)
+    try:
+        if key in context.stack[:-1]:
+            raise TagErrorCycle(tag.name, tag.args)
+        if len(context.stack) > lang._max_depth:
+            raise TagErrorDepth(tag.name, lang._max_depth)
+        async with semaphore:
+            processed = fn(*tag.args, **kwargs)
+            if asyncio.iscoroutine(processed):
+                processed = await processed
+    except ParseBaseException:
+        raise
+    except Exception as e:
+        raise TagErrorException(parsestr, tag.loc, e, lang._development)
+    if lang._reparse or isinstance(processed, TemplateText):
+        if lang._openseq in processed:
+            return await _render(lang, lang.compile(processed), context,
+                                 semaphore)
+    return processed
@@ -1,44 +1,601 @@
 import os
 import sys
+import stat
 import time
-import posixpath
+import json
+import codecs
+import hashlib
 import threading
 
-if sys.version > '3':
-    import urllib.parse
-    from http.server import HTTPServer
-    from http.server import SimpleHTTPRequestHandler
-else:
-    import urllib
-    from BaseHTTPServer import HTTPServer
-    from SimpleHTTPServer import SimpleHTTPRequestHandler
-
+from . import __version__
+from . import profiling
 from . import tags
 from . import utils
 from . import templatelang
 
+MANIFEST = '.tags-manifest'
+
+# The manifests of a build are kept in a folder of this name in the source
+# folder, not in the output folder, so that they're neither served nor 
+# published. It's never part of the source.
+STATE_DIR = '.tags-state'
+
+# The server, post-processing and process pool modules are only imported by
+# the commands that use them, to keep the startup of a build short. This is
+# postprocess.MANIFEST, which tells if a build needs post-processing.
+POSTPROCESS_MANIFEST = '.tags-postprocess'
+
+# The extensions of the destinations that are archives. They're here rather
+# than in archive, which imports tarfile and zipfile, so that telling an 
+# archive from a folder doesn't slow down the startup of every build.
+ARCHIVES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.zip')
+
+
 def build_file(filename, outfilename, root='.', create_dir=True):
+    error, dependencies = _build_file(filename, outfilename, root, create_dir)
+    if error:
+        print(error)
+
+
+def _render_file(filename, root='.'):
+    # Renders a file. Returns the parse error message if there is one, the
+    # output encoded as utf-8, and the files that the output depends on, 
+    # relative to the root folder. A file without tags is its own output.
+    filepath = os.path.join(root, filename)
+    dependencies = set()
+    with utils.open_file(filepath) as infile:
+        raw = infile.read()
+    if not tags.lang.contains_tags(raw):
+        return None, raw, []
+    try:
+        if sys.version > '3':
+            content = str(raw, 'utf-8')
+        else:
+            content = unicode(raw, 'utf-8')
+        output = tags.render(content, filename=filename, rootdir=root,
+                             dependencies=dependencies)
+    except templatelang.ParseBaseException as e:
+        return utils.format_parse_exception(e, filename), None, None
+
+    dependencies = sorted(os.path.relpath(path, root) for path in dependencies)
+    return None, output.encode('utf-8'), dependencies
+
+
+def _build_file(filename, outfilename, root='.', create_dir=True, 
+                profiler=None, checksum=False):
+    # Builds a file. Returns the parse error message if there is one, and the
+    # files that the output depends on, relative to the root folder. The
+    # output is written as it's rendered, to a temporary file that replaces
+    # the output when it's done, so a failed build leaves the old output.
+    # With a profiler, the time of each phase is recorded.
+    start = profiling.timer()
     filepath = os.path.join(root, filename)
     with utils.open_file(filepath) as infile:
+        raw = infile.read()
+    if profiler is not None:
+        profiler.add(filename, 'read', profiling.timer() - start)
+
+    # a file without tags renders to itself, so it's copied like a static
+    # file without being decoded, and not at all if the output is the same.
+    # It's never hard linked, since post-processing may rewrite the output.
+    if not tags.lang.contains_tags(raw):
+        start = profiling.timer()
+        utils.sync_file(filepath, outfilename, checksum=checksum, 
+                        create_dir=create_dir)
+        if profiler is not None:
+            profiler.add(filename, 'copy', profiling.timer() - start)
+        return None, []
+
+    if sys.version > '3':
+        content = str(raw, 'utf-8')
+    else:
+        content = unicode(raw, 'utf-8')
+    if profiler is not None:
         try:
-            if sys.version > '3':
-                content = str(infile.read(), 'utf-8')
-            else:
-                content = unicode(infile.read(), 'utf-8')
-            output = tags.render(content, filename=filename, rootdir=root)
-        except templatelang.ParseBaseException as e:
-            utils.print_parse_exception(e, filename)
-            return
+            with profiler.phase(filename, 'compile'):
+                tags.lang.compile(content)
+        except templatelang.ParseBaseException:
+            pass
 
-    with utils.open_file(outfilename, "w", create_dir=create_dir) as outfile:
-        if sys.version > '3':
-            outfile.write(output)
+    folder, basename = os.path.split(outfilename)
+    if create_dir:
+        utils.make_dirs(folder or '.')
+    tmpfilename = os.path.join(folder, '.' + basename + '.tmp')
+    dependencies = set()
+    start = profiling.timer()
+    try:
+        with open(tmpfilename, 'wb') as outfile:
+            stream = codecs.getwriter('utf-8')(outfile)
+            if profiler is not None:
+                stream = profiling.TimedStream(stream)
+            tags.render_to(stream, content, filename=filename, rootdir=root, 
+                           dependencies=dependencies)
+    except templatelang.ParseBaseException as e:
+        os.remove(tmpfilename)
+        return utils.format_parse_exception(e, filename), None
+    except:
+        os.remove(tmpfilename)
+        raise
+    rendered = profiling.timer()
+    utils.replace_file(tmpfilename, outfilename)
+    if profiler is not None:
+        profiler.add(filename, 'render', rendered - start - stream.seconds)
+        profiler.add(filename, 'write', 
+                     profiling.timer() - rendered + stream.seconds)
+
+    return None, sorted(os.path.relpath(path, root) for path in dependencies)
+
+
+def _use_cache(cache_dir):
+    # a worker process keeps its compiled templates in cache_dir, whether 
+    # it's forked or spawned
+    if cache_dir and (tags.lang.cache is None or 
+                      tags.lang.cache.folder != cache_dir):
+        from .templatecache import TemplateCache
+        tags.lang.cache = TemplateCache(cache_dir)
+
+
+def _render_task(filename, root, cache_dir):
+    # Renders a file of an archive in a worker process
+    _use_cache(cache_dir)
+    return _render_file(filename, root)
+
+
+def _build_task(args):
+    # Builds a file in a worker process, with its own profiler if profiling,
+    # whose timings are returned along with the result
+    filename, destfile, root, profile, checksum, cache_dir = args
+    _use_cache(cache_dir)
+    if not profile:
+        return (filename,) + _build_file(filename, destfile, root, 
+                                         checksum=checksum) + (None,)
+    profiler = profiling.Profiler()
+    tags.lang.profiler = profiler
+    try:
+        result = _build_file(filename, destfile, root, profiler=profiler,
+                             checksum=checksum)
+    finally:
+        tags.lang.profiler = None
+    return (filename,) + result + (profiler.as_dict(),)
+
+
+def _copy_file(src, dst, root, copy_options, profiler=None, srcstat=None):
+    if profiler is None:
+        return utils.sync_file(src, dst, srcstat=srcstat, **copy_options)
+    with profiler.phase(os.path.relpath(src, root), 'copy'):
+        return utils.sync_file(src, dst, srcstat=srcstat, **copy_options)
+
+
+def _build_serial(builds, copies, root, copied, copy_options, profiler=None):
+    # copied gets the bytes copied and skipped for each of the copies
+    for filename, destfile in builds:
+        yield (filename,) + _build_file(filename, destfile, root, 
+                                        profiler=profiler,
+                                        checksum=copy_options['checksum'])
+    for src, dst, srcstat in copies:
+        copied.append(_copy_file(src, dst, root, copy_options, profiler,
+                                 srcstat))
+
+
+def _build_parallel(builds, copies, root, jobs, copied, copy_options, 
+                    profiler=None, cache_dir=None):
+    # Templates are rendered in a pool of processes, each of which keeps its
+    # parser and caches between files. Static files are copied by a pool of
+    # threads meanwhile. Results are yielded in the same order as they would
+    # be by a serial build. map submits every task at once, which starts the
+    # worker processes, before the threads start: forking a process while 
+    # other threads hold locks would leave the locks held in the child.
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    with ProcessPoolExecutor(jobs) as processes:
+        chunksize = max(1, len(builds) // (jobs * 4))
+        tasks = [(filename, destfile, root, profiler is not None,
+                  copy_options['checksum'], cache_dir) 
+                 for filename, destfile in builds]
+        results = processes.map(_build_task, tasks, chunksize=chunksize)
+        with ThreadPoolExecutor(jobs) as threads:
+            copying = [threads.submit(_copy_file, src, dst, root, 
+                                      copy_options, profiler, srcstat)
+                       for src, dst, srcstat in copies]
+            for result in results:
+                if result[3] is not None:
+                    profiler.merge(result[3])
+                yield result[:3]
+            for future in copying:
+                copied.append(future.result())
+
+
+# The manifest records the source file signature (mtime and size) of every
+# output in the destination folder, and the signatures of the partials it
+# includes. Incremental builds only rebuild outputs whose inputs changed.
+
+def _state_dir(root, dest):
+    # the folder of the manifests of dest in root, named after the full path
+    # of dest since the same site can be built into several folders
+    dest = os.path.abspath(dest)
+    return os.path.join(root, STATE_DIR, 
+                        hashlib.sha1(dest.encode('utf-8')).hexdigest())
+
+
+def _move_manifests(dest, state):
+    # the manifests of older versions are moved out of dest
+    for name in (MANIFEST, POSTPROCESS_MANIFEST):
+        path = os.path.join(dest, name)
+        if not os.path.exists(path):
+            continue
+        if os.path.exists(os.path.join(state, name)):
+            os.remove(path)
         else:
-            outfile.write(output.encode('utf-8'))
+            utils.make_dirs(state)
+            utils.replace_file(path, os.path.join(state, name))
+
+
+def _manifest_settings(root, pattern, exclude):
+    # a manifest made with different settings or tags can't be trusted
+    return {
+        'version': __version__,
+        'pattern': utils.compile_pattern(pattern).patterns,
+        'exclude': utils.compile_pattern(exclude).patterns,
+        'tags': os.path.getmtime(tags.__file__),
+    }
+
+
+def _load_manifest(folder):
+    try:
+        with utils.open_file(os.path.join(folder, MANIFEST), 'r') as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST)
+    # without indent, json encodes the manifest in C, which matters for
+    # large sites
+    with utils.open_file(path, 'w', create_dir=True) as outfile:
+        outfile.write(json.dumps(manifest, sort_keys=True, 
+                                 separators=(',', ':')))
+
+
+def _signature(path, signatures):
+    # signatures caches the signature of each file for the current build
+    if path not in signatures:
+        try:
+            signatures[path] = list(utils.file_signature(path))
+        except OSError:
+            signatures[path] = None
+    return signatures[path]
+
+
+def _is_current(entry, signature, root, signatures):
+    # whether the output recorded by a manifest entry is up to date
+    if entry['source'] != signature:
+        return False
+    for dependency, depsignature in entry.get('dependencies', {}).items():
+        path = os.path.join(root, dependency)
+        if _signature(path, signatures) != depsignature:
+            return False
+    return True
+
+
+def _entries(root, filenames):
+    # the entries of the files among filenames that exist in root
+    entries = []
+    for filename in filenames:
+        entry = utils.FileEntry(filename, os.path.join(root, filename))
+        try:
+            if stat.S_ISREG(entry.stat().st_mode):
+                entries.append(entry)
+        except OSError:
+            pass
+    return entries
+
+
+def _remove_output(dest, filename):
+    # removes an output, and any folders left empty within dest
+    path = os.path.join(dest, filename)
+    try:
+        os.remove(path)
+        folder = os.path.dirname(filename)
+        while folder:
+            os.rmdir(os.path.join(dest, folder))
+            folder = os.path.dirname(folder)
+    except OSError:
+        pass
 
             
+def _exclude_patterns(root, dest, exclude, cache_dir=None):
+    # the state folder, and the output and cache folders if they're inside 
+    # root, are never part of the source
+    exclude = utils.compile_pattern(exclude).patterns + [STATE_DIR + '/**']
+    for folder in (dest, cache_dir):
+        if not folder:
+            continue
+        relpath = os.path.relpath(os.path.abspath(folder), 
+                                  os.path.abspath(root))
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            continue
+        relpath = relpath.replace(os.sep, '/')
+        exclude = exclude + [utils.escape_pattern(relpath) + '/**']
+    return exclude
+
+
+def _dependents(outputs, changed):
+    # the outputs that include any of the changed files
+    changed = set(changed)
+    return set(filename for filename, entry in outputs.items()
+               if changed.intersection(entry.get('dependencies', ())))
+
+
+def _is_archive(dest):
+    return dest == '-' or dest.lower().endswith(ARCHIVES)
+
+
+def _build_archive(root, dest, pattern, exclude, jobs, profiler=None, 
+                   cache=None):
+    # Builds every file straight into the archive dest, see archive.py. 
+    # Messages go to stderr when the archive goes to stdout. A file archive
+    # is written next to dest and replaces it when it's done, so a failed 
+    # build leaves the old archive.
+    from . import archive
+
+    log = sys.stderr if dest == '-' else sys.stdout
+    log.write("Building site from '{0}' into '{1}'\n".format(root, dest))
+
+    included = utils.compile_pattern(pattern)
+    excluded = utils.compile_pattern(_exclude_patterns(
+        root, None, exclude, cache and cache.folder))
+    if dest == '-':
+        stream = getattr(sys.stdout, 'buffer', sys.stdout)
+        tmpfilename = None
+        skipped = ()
+    else:
+        folder, basename = os.path.split(dest)
+        if folder:
+            utils.make_dirs(folder)
+        tmpfilename = os.path.join(folder, '.' + basename + '.tmp')
+        stream = open(tmpfilename, 'wb')
+        # the archive isn't part of the source, if it's inside root
+        skipped = set(os.path.relpath(os.path.abspath(path), 
+                                      os.path.abspath(root))
+                      for path in (dest, tmpfilename))
+
+    # files are added in order of their names, whatever the order of the
+    # folders on disk, so that the archive is reproducible
+    with profiling.step(profiler, 'scan'):
+        entries = sorted(
+            (entry for entry in utils.scan_folder(root or '.', 
+                                                  exclude=excluded)
+             if entry.name not in skipped 
+                and not excluded.matches(entry.name)),
+            key=lambda entry: entry.name.replace(os.sep, '/'))
+        pages = [entry.name for entry in entries 
+                 if included.matches(entry.name)]
+
+    written = [0, 0]
+    langprofiler, tags.lang.profiler = tags.lang.profiler, profiler
+    langcache, tags.lang.cache = tags.lang.cache, cache
+    try:
+        writer = archive.open_archive(dest, stream)
+        with profiling.step(profiler, 'build'):
+            if jobs > 1 and len(pages) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                processes = ProcessPoolExecutor(jobs)
+                chunksize = max(1, len(pages) // (jobs * 4))
+                cache_dir = cache and cache.folder
+                rendered = processes.map(_render_task, pages, 
+                                         [root] * len(pages), 
+                                         [cache_dir] * len(pages),
+                                         chunksize=chunksize)
+            else:
+                processes = None
+                rendered = (_render_file(filename, root) 
+                            for filename in pages)
+            try:
+                for entry in entries:
+                    start = profiling.timer()
+                    if not included.matches(entry.name):
+                        writer.add_file(entry.name, entry.path, entry.stat())
+                        written[1] += entry.stat().st_size
+                        if profiler is not None:
+                            profiler.add(entry.name, 'copy', 
+                                         profiling.timer() - start)
+                        continue
+                    error, content, dependencies = next(rendered)
+                    if profiler is not None and processes is None:
+                        profiler.add(entry.name, 'render', 
+                                     profiling.timer() - start)
+                    if error:
+                        log.write(error + '\n')
+                        continue
+                    writer.add_bytes(entry.name, content)
+                    written[0] += 1
+                    written[1] += len(content)
+            finally:
+                if processes is not None:
+                    processes.shutdown()
+        writer.close()
+    except:
+        if tmpfilename:
+            stream.close()
+            os.remove(tmpfilename)
+        raise
+    finally:
+        tags.lang.profiler = langprofiler
+        tags.lang.cache = langcache
+    if tmpfilename:
+        stream.close()
+        utils.replace_file(tmpfilename, dest)
+    else:
+        stream.flush()
+
+    log.write("Wrote {0} pages and {1} other files ({2}) into '{3}'\n".format(
+        written[0], len(entries) - len(pages), utils.format_size(written[1]),
+        dest))
+
+
+# A large site can be built by several machines, each building one shard of
+# the files into its own folder, which merge_shards then combines. Every
+# machine scans the whole source and assigns each file to a shard the same
+# way, either by a hash of its name, or by balancing the estimated cost of
+# the shards. The manifest of a shard records which shard it is and which
+# sources the whole site has, so the merge can check that every source was
+# built by exactly one shard.
+
+SHARD_BY = ('hash', 'cost')
+
+# rendering a page costs about this many times as much as copying a static
+# file of the same size, and every file costs at least FILE_COST bytes
+PAGE_COST = 8
+FILE_COST = 4096
+
+
+def _shard_files(entries, included, shard, shard_by='hash'):
+    # the names of the entries in shard (index, count), index from 1
+    index, count = shard
+    if shard_by == 'hash':
+        return set(
+            entry.name for entry in entries
+            if int(hashlib.sha1(entry.name.replace(os.sep, '/').encode(
+                'utf-8')).hexdigest(), 16) % count == index - 1)
+
+    # the most costly files first, each to the shard with the least cost yet
+    costs = []
+    for entry in entries:
+        try:
+            cost = max(entry.stat().st_size, FILE_COST)
+        except OSError:
+            cost = FILE_COST
+        if included.matches(entry.name):
+            cost *= PAGE_COST
+        costs.append((-cost, entry.name.replace(os.sep, '/'), entry.name))
+    loads = [0] * count
+    names = set()
+    for cost, key, name in sorted(costs):
+        least = loads.index(min(loads))
+        loads[least] -= cost
+        if least == index - 1:
+            names.add(name)
+    return names
+
+
+def _sources_digest(filenames):
+    # identifies the set of sources of a site, whatever the os
+    filenames = sorted(filename.replace(os.sep, '/') for filename in filenames)
+    return hashlib.sha1('\n'.join(filenames).encode('utf-8')).hexdigest()
+
+
+def _merge_error(msg):
+    print("Oops, " + msg)
+    sys.exit(1)
+
+
+def merge_shards(shards, dest='_site', link=False, checksum=False, 
+                 compress=False, fingerprint=False, jobs=1, root='.'):
+    ''' Combines the output folders of the shards of a build into dest. 
+
+    Checks that the shards are all the shards of the same site, and that 
+    every source was built by exactly one of them, then syncs their outputs
+    into dest and writes a manifest of all of them. Outputs in dest that no
+    shard has are removed. Pages are always copied, even with link, since 
+    post-processing may rewrite them. The manifests of dest are kept in the
+    source folder root, like those of a build.
+    '''
+    print("Merging {0} shards into '{1}'".format(len(shards), dest))
+    manifests = []
+    for folder in shards:
+        manifest = _load_manifest(folder)
+        if 'shard' not in manifest:
+            _merge_error("'{0}' isn't the output of a shard.".format(folder))
+        manifests.append(manifest)
+
+    first = manifests[0]
+    count = first['shard']['count']
+    indices = sorted(manifest['shard']['index'] for manifest in manifests)
+    if indices != list(range(1, count + 1)):
+        _merge_error("the site has {0} shards, but these are shards {1}.".format(
+            count, ', '.join(str(index) for index in indices)))
+    # the time of the tags module can differ between machines
+    keys = ('version', 'pattern', 'exclude')
+    for folder, manifest in zip(shards, manifests):
+        if (manifest['shard']['count'] != count or 
+                manifest['shard']['by'] != first['shard']['by'] or
+                manifest['shard']['sources'] != first['shard']['sources'] or
+                [manifest['settings'].get(key) for key in keys] != 
+                [first['settings'].get(key) for key in keys]):
+            _merge_error("'{0}' and '{1}' are shards of different builds."
+                         .format(shards[0], folder))
+
+    outputs, owners, failed = {}, {}, []
+    for folder, manifest in zip(shards, manifests):
+        failed.extend(manifest['shard']['failed'])
+        for filename, entry in manifest['outputs'].items():
+            if filename in owners:
+                _merge_error("'{0}' was built by '{1}' and by '{2}'.".format(
+                    filename, owners[filename], folder))
+            owners[filename] = folder
+            outputs[filename] = entry
+    if failed:
+        _merge_error("{0} files failed to build: {1}".format(
+            len(failed), ', '.join(sorted(failed))))
+    sources = first['shard']['sources']
+    if (len(outputs) != sources['count'] or 
+            _sources_digest(outputs) != sources['digest']):
+        _merge_error("the shards built {0} of the {1} sources.".format(
+            len(outputs), sources['count']))
+
+    included = utils.compile_pattern(first['settings']['pattern'])
+    copied = []
+    for filename in sorted(outputs):
+        page = included.matches(filename)
+        copied.append(utils.sync_file(
+            os.path.join(owners[filename], filename), 
+            os.path.join(dest, filename),
+            checksum=checksum, link=link and not page))
+    copied_files = sum(1 for done, skipped in copied if done)
+    print("Copied {0} files ({1}), {2} files didn't need copying".format(
+        copied_files, 
+        utils.format_size(sum(done for done, skipped in copied)),
+        len(copied) - copied_files))
+
+    state = _state_dir(root, dest)
+    _move_manifests(dest, state)
+    for filename in _load_manifest(state).get('outputs', {}):
+        if filename not in outputs:
+            _remove_output(dest, filename)
+    _save_manifest(state, {'settings': first['settings'], 'outputs': outputs})
+
+    if (compress or fingerprint or 
+            os.path.exists(os.path.join(state, POSTPROCESS_MANIFEST))):
+        from . import postprocess
+        processed, compressed = postprocess.postprocess(
+            dest, 
+            state=state,
+            outputs=list(outputs), 
+            pages=[filename for filename in outputs 
+                   if included.matches(filename)],
+            compress=compress, 
+            fingerprint=fingerprint, 
+            jobs=jobs)
+        if compress or fingerprint:
+            print("Post-processed {0} changed files, compressed {1}".format(
+                processed, compressed))
+
+
 def build_files(root='.', dest='_site', pattern='**/*.html', 
-                exclude='_*/**', watch=False, force=False):
+                exclude='_*/**', watch=False, force=False, jobs=1,
+                incremental=True, changed=None, link=False, checksum=False,
+                compress=False, fingerprint=False, profiler=None, 
+                shard=None, shard_by='hash', cache_dir=None):
+    ''' Builds the site in root into dest.
+
+    With shard, a pair (index, count) with index from 1 to count, only the 
+    files of that shard of the site are built, see merge_shards. With 
+    cache_dir, compiled templates are kept in that folder between builds,
+    see templatecache.
+    '''
+    # stdout is the archive with dest '-'
+    log = sys.stderr if dest == '-' else sys.stdout
     try:
         os.stat(os.path.join(root, 'index.html'))
     except OSError:
@@ -46,121 +603,420 @@ def build_files(root='.', dest='_site', pattern='**/*.html',
             msg = "Oops, we can't find an index.html in the source folder.\n"+\
                   "If you want to build this folder anyway, use the --force\n"+\
                   "option."
-            print(msg)
+            log.write(msg + '\n')
             sys.exit(1)
 
+    exclude = exclude or []
+    if not jobs:
+        import multiprocessing
+        jobs = multiprocessing.cpu_count()
+
+    cache = None
+    if cache_dir:
+        from .templatecache import TemplateCache
+        cache = TemplateCache(cache_dir)
+
+    if _is_archive(dest):
+        if watch or compress or fingerprint or shard is not None:
+            log.write("Oops, --watch, --compress, --fingerprint and --shard "
+                      "need an output folder, not an archive.\n")
+            sys.exit(1)
+        _build_archive(root, dest, pattern, exclude, jobs, profiler, cache)
+        if cache is not None:
+            cache.prune()
+        return
+    if shard is not None and (watch or compress or fingerprint):
+        print("Oops, --watch, --compress and --fingerprint don't work with "
+              "--shard, use them with merge instead.")
+        sys.exit(1)
+
     print("Building site from '{0}' into '{1}'".format(root, dest))
 
-    exclude = exclude or os.path.join(dest, '**')
-    for filename in utils.walk_folder(root or '.'):
-        included = utils.matches_pattern(pattern, filename)
-        excluded = utils.matches_pattern(exclude, filename)
-        destfile = os.path.join(dest, filename)
-        if included and not excluded: 
-            build_file(filename, destfile, root=root)
-        elif not excluded:
-            filepath = os.path.join(root, filename)
-            destpath = os.path.join(dest, filename)
-            utils.copy_file(filepath, destpath)
+    settings = _manifest_settings(root, pattern, exclude)
+    included = utils.compile_pattern(pattern)
+    excluded = utils.compile_pattern(_exclude_patterns(root, dest, exclude,
+                                                       cache_dir))
+
+    # a shard is moved to another machine along with its manifest
+    if shard is not None:
+        state = dest
+    else:
+        state = _state_dir(root, dest)
+        _move_manifests(dest, state)
+    manifest = _load_manifest(state)
+    previous = manifest.get('outputs', {})
+    # files that failed to build have no outputs, and aren't known to depend
+    # on anything, so they're tried again by every build
+    previous_failed = manifest.get('failed', [])
+    if not incremental or manifest.get('settings') != settings:
+        current = {}
+    else:
+        current = previous
+
+    # if we know which files changed, only those and the outputs that depend
+    # on them need to be checked, otherwise check every file. Each file is
+    # statted once, by its entry, and the outputs that exist are found by
+    # reading the folders of dest instead of statting each output.
+    if changed is not None and current and shard is None:
+        candidates = (set(changed) | _dependents(current, changed) | 
+                      set(previous_failed))
+        outputs = dict((filename, entry) for filename, entry in current.items()
+                       if filename not in candidates)
+        entries = _entries(root, sorted(candidates))
+        written = None
+    else:
+        outputs = {}
+        entries = utils.scan_folder(root or '.', exclude=excluded)
+        written = set()
+        if current:
+            written = set(entry.name for entry in utils.scan_folder(dest))
+
+    signatures = {}
+    builds, copies = [], []
+    with profiling.step(profiler, 'scan'):
+        if shard is not None:
+            entries = [fileentry for fileentry in entries
+                       if not excluded.matches(fileentry.name)]
+            sources = [fileentry.name for fileentry in entries]
+            sharded = _shard_files(entries, included, shard, shard_by)
+        for fileentry in entries:
+            filename = fileentry.name
+            if excluded.matches(filename):
+                continue
+            if shard is not None and filename not in sharded:
+                continue
+            filepath = fileentry.path
+            try:
+                signature = list(fileentry.signature())
+            except OSError:
+                continue
+            signatures[filepath] = signature
+            entry = current.get(filename)
+            if written is None:
+                exists = entry and os.path.exists(os.path.join(dest, filename))
+            else:
+                exists = filename in written
+            if exists and _is_current(entry, signature, root, signatures):
+                outputs[filename] = entry
+                continue
+            outputs[filename] = {'source': signature}
+            destfile = os.path.join(dest, filename)
+            if included.matches(filename): 
+                builds.append((filename, destfile))
+            else:
+                copies.append((filepath, destfile, fileentry.stat()))
+
+    # static files that are already in dest aren't copied again
+    copied = []
+    copy_options = {'link': link, 'checksum': checksum}
+    if jobs > 1 and len(builds) + len(copies) > 1:
+        results = _build_parallel(builds, copies, root, jobs, copied, 
+                                  copy_options, profiler, cache_dir)
+    else:
+        results = _build_serial(builds, copies, root, copied, copy_options,
+                                profiler)
+    failed = set()
+    langprofiler, tags.lang.profiler = tags.lang.profiler, profiler
+    langcache, tags.lang.cache = tags.lang.cache, cache
+    try:
+        with profiling.step(profiler, 'build'):
+            for filename, error, dependencies in results:
+                if error:
+                    print(error)
+                    failed.add(filename)
+                    del outputs[filename]
+                    continue
+                outputs[filename]['dependencies'] = dict(
+                    (dependency, 
+                     _signature(os.path.join(root, dependency), signatures))
+                    for dependency in dependencies)
+    finally:
+        tags.lang.profiler = langprofiler
+        tags.lang.cache = langcache
+    if cache is not None:
+        cache.prune()
+
+    if copied:
+        copied_files = sum(1 for done, skipped in copied if done)
+        msg = "Copied {0} files ({1}), {2} files ({3}) didn't need copying"
+        print(msg.format(
+            copied_files, 
+            utils.format_size(sum(done for done, skipped in copied)),
+            len(copied) - copied_files, 
+            utils.format_size(sum(skipped for done, skipped in copied))))
+
+    for filename in set(previous).union(previous_failed):
+        if filename not in outputs and filename not in failed:
+            _remove_output(dest, filename)
+
+    manifest = {'settings': settings, 'outputs': outputs, 
+                'failed': sorted(failed)}
+    if shard is not None:
+        manifest['shard'] = {
+            'index': shard[0], 
+            'count': shard[1], 
+            'by': shard_by,
+            'sources': {'count': len(sources), 
+                        'digest': _sources_digest(sources)},
+            'failed': sorted(filename.replace(os.sep, '/') 
+                             for filename in failed),
+        }
+    _save_manifest(state, manifest)
+
+    # the post-processing stage also runs to undo what it did before, when
+    # it's no longer wanted
+    if (compress or fingerprint or 
+            os.path.exists(os.path.join(state, POSTPROCESS_MANIFEST))):
+        from . import postprocess
+        with profiling.step(profiler, 'postprocess'):
+            processed, compressed = postprocess.postprocess(
+                dest, 
+                state=state,
+                outputs=list(outputs), 
+                pages=[filename for filename in outputs 
+                       if included.matches(filename)],
+                compress=compress, 
+                fingerprint=fingerprint, 
+                jobs=jobs)
+        if compress or fingerprint:
+            print("Post-processed {0} changed files, compressed {1}".format(
+                processed, compressed))
 
     if watch:
-        observer = _watch(root=root,
-                          dest=dest,
-                          pattern=pattern,
-                          exclude=exclude)
-        if not observer:
+        _watch(root=root,
+               dest=dest,
+               pattern=pattern,
+               exclude=exclude,
+               jobs=jobs,
+               link=link,
+               checksum=checksum,
+               compress=compress,
+               fingerprint=fingerprint,
+               cache_dir=cache_dir)
+
+
+# Watching collects the paths of changed files until no more changes arrive
+# for WATCH_DELAY seconds, since saving a file often takes several events.
+# Then it rebuilds only the outputs affected by those files.
+
+WATCH_DELAY = 0.25
+
+
+class _Changes(object):
+
+    def __init__(self, root, dest, cache_dir=None):
+        self.root = os.path.abspath(root)
+        self.ignored = [os.path.abspath(folder) 
+                        for folder in (dest, os.path.join(root, STATE_DIR), 
+                                       cache_dir)
+                        if folder]
+        self._lock = threading.Lock()
+        self._paths = set()
+        self._rescan = False
+        self._time = None
+
+    def ignores(self, path):
+        # changes to the output, state or cache folders, or outside of root,
+        # don't count
+        path = os.path.abspath(path)
+        for folder in self.ignored:
+            if path == folder or path.startswith(folder + os.sep):
+                return True
+        relpath = os.path.relpath(path, self.root)
+        return relpath == os.pardir or relpath.startswith(os.pardir + os.sep)
+
+    def add(self, path, rescan=False):
+        if self.ignores(path):
             return
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            observer.stop()
-        observer.join()
+        with self._lock:
+            self._paths.add(os.path.relpath(os.path.abspath(path), self.root))
+            self._rescan = self._rescan or rescan
+            self._time = time.time()
 
+    def take(self, delay=WATCH_DELAY):
+        # returns the changed paths and whether the whole tree needs to be
+        # checked, once there are changes that have settled down
+        with self._lock:
+            if self._time is None or time.time() - self._time < delay:
+                return None
+            paths, rescan = sorted(self._paths), self._rescan
+            self._paths, self._rescan, self._time = set(), False, None
+            return paths, rescan
 
-def _watch(root='.', dest='_site', pattern='**/*.html', exclude='_*/**'):
 
+class _PollingObserver(threading.Thread):
+    # Checks the signatures of all files under root every interval seconds,
+    # for when watchdog isn't installed
+
+    def __init__(self, root, changes, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.root = root
+        self.changes = changes
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._files = self._scan()
+
+    def _scan(self):
+        files = {}
+        for subdir, dirs, filenames in os.walk(self.root):
+            dirs[:] = [d for d in dirs 
+                       if not self.changes.ignores(os.path.join(subdir, d))]
+            for filename in filenames:
+                path = os.path.join(subdir, filename)
+                try:
+                    files[path] = utils.file_signature(path)
+                except OSError:
+                    pass
+        return files
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            files = self._scan()
+            for path in set(files).union(self._files):
+                if files.get(path) != self._files.get(path):
+                    self.changes.add(path)
+            self._files = files
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _observe(root, changes):
     try:
         from watchdog.observers import Observer
         from watchdog.events import FileSystemEventHandler
     except ImportError:
-        msg = "The build --watch feature requires watchdog. \n"\
-            + "Please install it with 'easy_install watchdog'."
-        print(msg)
-        return None
+        print("Install watchdog with 'easy_install watchdog' to be notified\n"
+              "of changes, until then we'll check for changes every second.")
+        observer = _PollingObserver(root, changes)
+        observer.start()
+        return observer
 
     class handler(FileSystemEventHandler):
         def on_any_event(self, event):
-            exclude_path = os.path.join(os.getcwd(), exclude)
-            if not utils.matches_pattern(exclude_path, event.src_path):
-                build_files(root=root,
-                            dest=dest,
-                            pattern=pattern,
-                            exclude=exclude)
+            if event.event_type not in ('created', 'deleted', 'modified', 
+                                        'moved'):
+                return
+            if event.is_directory:
+                # changes to a folder's contents have events of their own,
+                # but a folder that appeared or went away needs a rescan
+                if event.event_type != 'modified':
+                    changes.add(event.src_path, rescan=True)
+                return
+            changes.add(event.src_path)
+            if getattr(event, 'dest_path', None):
+                changes.add(event.dest_path)
 
     observer = Observer()
     observer.schedule(handler(), root, recursive=True)
     observer.start()
+    return observer
+
+
+def _watch(root='.', dest='_site', pattern='**/*.html', exclude='_*/**',
+           jobs=1, link=False, checksum=False, compress=False, 
+           fingerprint=False, cache_dir=None):
+    # Rebuilds the files affected by changes under root until interrupted
+    changes = _Changes(root, dest, cache_dir)
+    observer = _observe(root, changes)
 
     print("Watching '{0}' ...".format(root))
 
-    return observer
+    try:
+        while True:
+            time.sleep(0.05)
+            taken = changes.take()
+            if not taken:
+                continue
+            paths, rescan = taken
+            build_files(root=root,
+                        dest=dest,
+                        pattern=pattern,
+                        exclude=exclude,
+                        force=True,
+                        jobs=jobs,
+                        changed=None if rescan else paths,
+                        link=link,
+                        checksum=checksum,
+                        compress=compress,
+                        fingerprint=fingerprint,
+                        cache_dir=cache_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+    observer.join()
 
 
-def serve_files(root='.', dest='_site', pattern='**/*.html', 
-                exclude='_*/**', watch=False, port=8000, force=False):
+class MemorySite(object):
+    ''' Renders the pages of a site on request, instead of building it.
 
-    # setup server
+    Rendered pages are kept in memory until their source, or one of the
+    partials they include, changes.
+    '''
 
-    class RequestHandler(SimpleHTTPRequestHandler):
-        
-        def translate_path(self, path):
-            root = os.path.join(os.getcwd(), dest)
+    def __init__(self, root='.', pattern='**/*.html', exclude='_*/**'):
+        self.root = root
+        self.included = utils.compile_pattern(pattern)
+        self.excluded = utils.compile_pattern(
+            _exclude_patterns(root, None, exclude))
+        self._pages = {}
 
-            # normalize path and prepend root directory
-            path = path.split('?',1)[0]
-            path = path.split('#',1)[0]
-            if sys.version > '3':
-                path = posixpath.normpath(urllib.parse.unquote(path))
-            else:
-                path = posixpath.normpath(urllib.unquote(path))
-            words = path.split('/')
-            words = [_f for _f in words if _f]
-            
-            path = root
-            for word in words:
-                drive, word = os.path.splitdrive(word)
-                head, word = os.path.split(word)
-                if word in (os.curdir, os.pardir):
-                    continue
-                path = os.path.join(path, word)
+    def excludes(self, filename):
+        return self.excluded.matches(filename)
 
-            return path
+    def excludes_folder(self, foldername):
+        return (foldername != os.curdir and 
+                self.excluded.matches_folder(foldername))
 
-    class StoppableHTTPServer(HTTPServer):
+    def renders(self, filename):
+        return self.included.matches(filename) and not self.excludes(filename)
+
+    def render(self, filename):
+        ''' Returns the parse error message if there is one, and the page
+        encoded as utf-8, or as it is if it has no tags. '''
+        signatures = {}
+        signature = _signature(os.path.join(self.root, filename), signatures)
+        entry = self._pages.get(filename)
+        if entry and _is_current(entry, signature, self.root, signatures):
+            return None, entry['content']
+
+        error, content, dependencies = _render_file(filename, self.root)
+        if error:
+            return error, None
+        self._pages[filename] = {
+            'source': signature,
+            'dependencies': dict(
+                (dependency, 
+                 _signature(os.path.join(self.root, dependency), signatures))
+                for dependency in dependencies),
+            'content': content,
+        }
+        return None, content
 
-        def serve_until_shutdown(self):
-            self._stopped = False
-            while not self._stopped:
-                try:
-                    httpd.handle_request()
-                except:
-                    self._stopped=True
-                    self.server_close()
 
+def serve_files(root='.', dest='_site', pattern='**/*.html', 
+                exclude='_*/**', watch=False, port=8000, force=False, jobs=1,
+                incremental=True, link=False, checksum=False,
+                workers=None, memory=False):
+    from . import server
+    workers = workers or server.WORKERS
+
+    if memory:
+        return _serve_memory(root=root,
+                             dest=dest,
+                             pattern=pattern,
+                             exclude=exclude,
+                             port=port,
+                             force=force,
+                             workers=workers)
 
-        def shutdown(self):
-            self._stopped = True            
-            self.server_close()
+    # setup server
 
-    server_address = ('', port)
-    httpd = StoppableHTTPServer(server_address, RequestHandler)
-    server_thread = threading.Thread(
-        target=httpd.serve_until_shutdown)
-    server_thread.daemon = True
-    server_thread.start()
+    httpd = server.start_server(root=dest, port=port, workers=workers)
 
-    print("HTTP server started on port {0}".format(server_address[1]))
+    print("HTTP server started on port {0}".format(httpd.server_address[1]))
 
     # build files
 
@@ -168,31 +1024,64 @@ def serve_files(root='.', dest='_site', pattern='**/*.html',
                 dest=dest,
                 pattern=pattern,
                 exclude=exclude,
-                force=force)
+                force=force,
+                jobs=jobs,
+                incremental=incremental,
+                link=link,
+                checksum=checksum)
 
     # watch files while server running
 
     if watch:
-        observer = _watch(root=root,
-                          dest=dest,
-                          pattern=pattern,
-                          exclude=exclude)
-        if not observer:
-            return
-        try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            observer.stop()
-            httpd.shutdown()
-        observer.join()
+        _watch(root=root,
+               dest=dest,
+               pattern=pattern,
+               exclude=exclude,
+               jobs=jobs,
+               link=link,
+               checksum=checksum)
 
     else:
         try:
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
-            httpd.shutdown()
+            pass
+
+    server.stop_server(httpd)
+
+
+def _serve_memory(root='.', dest='_site', pattern='**/*.html', 
+                  exclude='_*/**', port=8000, force=False, 
+                  workers=None):
+    # Serves the site straight from root, rendering pages as they're
+    # requested. Nothing is written, so there's no build to wait for and
+    # nothing to watch.
+    if not force and not os.path.exists(os.path.join(root, 'index.html')):
+        msg = "Oops, we can't find an index.html in the source folder.\n"+\
+              "If you want to serve this folder anyway, use the --force\n"+\
+              "option."
+        print(msg)
+        sys.exit(1)
+
+    from . import server
+    workers = workers or server.WORKERS
+    site = MemorySite(root=root,
+                      pattern=pattern,
+                      exclude=_exclude_patterns(root, dest, exclude or []))
+    httpd = server.start_server(root=root, port=port, workers=workers,
+                                handler=server.PreviewHandler, site=site)
+
+    print("HTTP server started on port {0}, serving '{1}' from memory".format(
+        httpd.server_address[1], root))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    server.stop_server(httpd)
 
 
 
@@ -0,0 +1,242 @@
+'''
+An optional stage that runs on the output folder after a build.
+
+It can give static assets a fingerprinted copy, style.<hash>.css next to
+style.css, and point the references to them in the built pages at the copy,
+so that a CDN can cache them forever. And it can write .gz and .br files next
+to the outputs that compress well, for servers that send precompressed files.
+
+What it did is recorded in a manifest, with the hash of each output, so 
+outputs that didn't change aren't processed again.
+'''
+
+import os
+import re
+import json
+import posixpath
+import mimetypes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from . import utils
+
+
+MANIFEST = '.tags-postprocess'
+
+FINGERPRINTED = ('.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.svg',
+                 '.webp', '.ico', '.woff', '.woff2', '.ttf', '.otf', '.eot')
+HASH_LENGTH = 10
+
+# matched in the bytes of a page, which isn't necessarily utf-8
+_REFERENCE = re.compile(br'''(\b(?:src|href)\s*=\s*)(["']?)([^"'\s>]+)\2''',
+                        re.IGNORECASE)
+
+
+def _fingerprinted_name(filename, digest):
+    base, ext = posixpath.splitext(filename)
+    return '{0}.{1}{2}'.format(base, digest[:HASH_LENGTH], ext)
+
+
+def _compressible(filename):
+    ctype = mimetypes.guess_type(filename)[0] or ''
+    return utils.compressible(ctype)
+
+
+def _encodings():
+    encodings = [('.gz', utils.gzip_bytes)]
+    if brotli is not None:
+        encodings.append(('.br', brotli.compress))
+    return encodings
+
+
+def _compress(path):
+    # writes the compressed siblings of path, unless compressing doesn't help
+    with open(path, 'rb') as afile:
+        content = afile.read()
+    written = []
+    for ext, compress in _encodings():
+        compressed = compress(content)
+        if len(compressed) >= len(content):
+            _remove(path + ext)
+            continue
+        with open(path + ext, 'wb') as outfile:
+            outfile.write(compressed)
+        written.append(ext)
+    return written
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _rewrite(path, page, mapping):
+    # points the src and href attributes of the page at path that refer to
+    # assets in mapping at their fingerprinted copies
+    folder = posixpath.dirname(page)
+
+    def _replace(match):
+        try:
+            url = match.group(3).decode('utf-8')
+        except UnicodeDecodeError:
+            return match.group(0)
+        if ':' in url or url.startswith('//'):
+            return match.group(0)
+        urlpath = re.split('[?#]', url, 1)[0]
+        suffix = url[len(urlpath):]
+        if urlpath.startswith('/'):
+            target = posixpath.normpath(urlpath.lstrip('/'))
+        else:
+            target = posixpath.normpath(posixpath.join(folder, urlpath))
+        if target not in mapping:
+            return match.group(0)
+        urlpath = posixpath.join(posixpath.dirname(urlpath),
+                                 posixpath.basename(mapping[target]))
+        return match.group(1) + match.group(2) + \
+            (urlpath + suffix).encode('utf-8') + match.group(2)
+
+    with open(path, 'rb') as afile:
+        content = afile.read()
+    rewritten = _REFERENCE.sub(_replace, content)
+    if rewritten != content:
+        with open(path, 'wb') as outfile:
+            outfile.write(rewritten)
+
+
+def _map(fn, items, jobs):
+    if jobs > 1 and len(items) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(jobs) as threads:
+            return list(threads.map(fn, items))
+    return [fn(item) for item in items]
+
+
+def _load_manifest(folder):
+    try:
+        with open(os.path.join(folder, MANIFEST), 'r') as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_manifest(folder, manifest):
+    with utils.open_file(os.path.join(folder, MANIFEST), 'w',
+                         create_dir=True) as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+
+
+def postprocess(dest, outputs, pages=(), compress=True, fingerprint=False,
+                jobs=1, state=None):
+    ''' Fingerprints and compresses the outputs of a build in dest.
+
+    outputs are the filenames of all outputs relative to dest, and pages the
+    ones that are rendered templates, whose references to fingerprinted
+    assets are rewritten. Compression and hashing run in jobs threads. The
+    manifest is kept in the folder state, by default dest.
+    '''
+    state = state or dest
+    manifest = _load_manifest(state)
+    settings = {'compress': compress, 'fingerprint': fingerprint,
+                'encodings': [ext for ext, fn in _encodings()]}
+    # the old entries are still needed to clean up after different settings
+    old = manifest.get('files', {})
+    previous = old if manifest.get('settings') == settings else {}
+    previous_assets = manifest.get('assets', {})
+
+    # outputs whose signature didn't change since the last run are skipped,
+    # the others are hashed to find out if their contents changed
+    outputs = sorted(filename.replace(os.sep, '/') for filename in outputs)
+    pages = set(filename.replace(os.sep, '/') for filename in pages)
+    signatures = {}
+    for filename in outputs:
+        try:
+            signatures[filename] = list(utils.file_signature(
+                os.path.join(dest, filename)))
+        except OSError:
+            pass
+    outputs = [filename for filename in outputs if filename in signatures]
+    changed = [filename for filename in outputs
+               if previous.get(filename, {}).get('signature') !=
+                  signatures[filename]]
+    unchanged = set(outputs).difference(changed)
+    digests = dict((filename, previous[filename]['hash'])
+                   for filename in unchanged)
+    digests.update(zip(changed, _map(
+        lambda filename: utils.hash_file(os.path.join(dest, filename)),
+        changed, jobs)))
+
+    # fingerprinted copies of static assets
+    assets = {}
+    if fingerprint:
+        for filename in outputs:
+            if filename not in pages and filename.endswith(FINGERPRINTED):
+                assets[filename] = _fingerprinted_name(filename,
+                                                       digests[filename])
+        for filename, copy in assets.items():
+            utils.sync_file(os.path.join(dest, filename),
+                            os.path.join(dest, copy), checksum=True)
+    for filename, copy in previous_assets.items():
+        if assets.get(filename) != copy:
+            for ext in ('', '.gz', '.br'):
+                _remove(os.path.join(dest, copy + ext))
+
+    # pages are rewritten when they were rebuilt, or when an asset they may
+    # refer to was fingerprinted differently. A page that wasn't rebuilt
+    # still refers to the previous copies.
+    if assets != previous_assets:
+        rewrite = [page for page in outputs if page in pages]
+    else:
+        rewrite = [page for page in changed if page in pages]
+    mapping = dict(assets)
+    for filename, copy in previous_assets.items():
+        mapping[copy] = assets.get(filename, filename)
+    if mapping:
+        for page in rewrite:
+            _rewrite(os.path.join(dest, page), page, mapping)
+            path = os.path.join(dest, page)
+            signatures[page] = list(utils.file_signature(path))
+            digests[page] = utils.hash_file(path)
+
+    # compressed siblings of everything that changed, including the copies
+    outputs_set = set(outputs)
+    files = {}
+    wanted = set()
+    compressing = []
+    for filename in outputs:
+        compressed = old.get(filename, {}).get('compressed', [])
+        if (compress and _compressible(filename) and
+                signatures[filename][1] >= utils.MIN_COMPRESS and
+                not any(filename + ext in outputs_set
+                        for ext, fn in _encodings())):
+            wanted.add(filename)
+            if previous.get(filename, {}).get('hash') != digests[filename]:
+                compressing.append(filename)
+        else:
+            for ext in compressed:
+                _remove(os.path.join(dest, filename + ext))
+            compressed = []
+        files[filename] = {'signature': signatures[filename],
+                           'hash': digests[filename],
+                           'compressed': compressed}
+    for filename in old:
+        if filename not in files:
+            for ext in old[filename].get('compressed', []):
+                _remove(os.path.join(dest, filename + ext))
+
+    compressing += [copy for filename, copy in assets.items()
+                    if filename in wanted and (filename in compressing or
+                        previous_assets.get(filename) != copy)]
+    written = _map(lambda filename: _compress(os.path.join(dest, filename)),
+                   compressing, jobs)
+    for filename, exts in zip(compressing, written):
+        if filename in files:
+            files[filename]['compressed'] = exts
+
+    _save_manifest(state, {'settings': settings, 'files': files,
+                          'assets': assets})
+    return len(changed), len(compressing)
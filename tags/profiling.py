@@ -0,0 +1,181 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+if hasattr(time, 'perf_counter'):
+    timer = time.perf_counter
+else:
+    timer = time.time
+
+
+class Profiler(object):
+    ''' Collects where the time of a build goes.
+
+    For each tag it counts the calls, the cumulative time spent in the tag
+    function, and the self time: the cumulative time minus the time spent in
+    tags called by it, like the tags of an included partial. For each file
+    it records the time of each phase of building it, and for the build as a
+    whole, the time of each step.
+
+    A TemplateLanguage records tag timings into its profiler attribute. The
+    generator records file phases and build steps when build_files is given
+    a profiler. Profilers are safe to use from several threads.
+    '''
+
+    def __init__(self):
+        self.tags = {}
+        self.files = {}
+        self.steps = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def tag(self, name):
+        # the stack holds the time spent in nested tags for each active tag
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(0.0)
+        start = timer()
+        try:
+            yield
+        finally:
+            elapsed = timer() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                stats = self.tags.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] += elapsed - nested
+
+    def add_tag(self, name, seconds):
+        # for tags that can't be timed with tag, like async ones that run
+        # interleaved with other tags. All of their time is self time.
+        with self._lock:
+            stats = self.tags.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += seconds
+
+    def add(self, filename, phase, seconds):
+        with self._lock:
+            phases = self.files.setdefault(filename, {})
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, filename, phase):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.add(filename, phase, timer() - start)
+
+    @contextmanager
+    def step(self, name):
+        start = timer()
+        try:
+            yield
+        finally:
+            elapsed = timer() - start
+            with self._lock:
+                self.steps[name] = self.steps.get(name, 0.0) + elapsed
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'tags': dict((name, {'calls': calls, 'cumulative': total,
+                                     'self': own})
+                             for name, (calls, total, own) in self.tags.items()),
+                'files': dict((filename, dict(phases))
+                              for filename, phases in self.files.items()),
+                'steps': dict(self.steps),
+            }
+
+    def merge(self, data):
+        ''' Adds the timings of another profiler's as_dict, like the ones
+        collected by a worker process. '''
+        with self._lock:
+            for name, stats in data.get('tags', {}).items():
+                mine = self.tags.setdefault(name, [0, 0.0, 0.0])
+                mine[0] += stats['calls']
+                mine[1] += stats['cumulative']
+                mine[2] += stats['self']
+            for filename, phases in data.get('files', {}).items():
+                mine = self.files.setdefault(filename, {})
+                for phase, seconds in phases.items():
+                    mine[phase] = mine.get(phase, 0.0) + seconds
+            for name, seconds in data.get('steps', {}).items():
+                self.steps[name] = self.steps.get(name, 0.0) + seconds
+
+    def dump(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.as_dict(), outfile, indent=1, sort_keys=True)
+
+    def report(self, top=20):
+        ''' Returns a report of the build steps, and the top slowest files
+        and tags. '''
+        data = self.as_dict()
+        lines = []
+
+        if data['steps']:
+            lines.append("Build steps:")
+            for name, seconds in sorted(data['steps'].items(),
+                                        key=lambda item: -item[1]):
+                lines.append("  {0:<24} {1:>9.3f}s".format(name, seconds))
+
+        files = sorted(data['files'].items(),
+                       key=lambda item: -sum(item[1].values()))[:top]
+        if files:
+            phases = sorted(set(phase for filename, timings in files
+                                for phase in timings))
+            lines.append("Slowest {0} files:".format(len(files)))
+            lines.append("  {0:<40} {1:>9}".format("file", "total") +
+                         "".join(" {0:>9}".format(phase) for phase in phases))
+            for filename, timings in files:
+                lines.append(
+                    "  {0:<40} {1:>8.3f}s".format(filename,
+                                                  sum(timings.values())) +
+                    "".join(" {0:>8.3f}s".format(timings.get(phase, 0.0))
+                            for phase in phases))
+
+        tags = sorted(data['tags'].items(),
+                      key=lambda item: -item[1]['self'])[:top]
+        if tags:
+            lines.append("Slowest {0} tags, by self time:".format(len(tags)))
+            lines.append("  {0:<24} {1:>9} {2:>10} {3:>10} {4:>10}".format(
+                "tag", "calls", "cumulative", "self", "per call"))
+            for name, stats in tags:
+                lines.append(
+                    "  {0:<24} {1:>9} {2:>9.3f}s {3:>9.3f}s {4:>8.3f}ms".format(
+                        name, stats['calls'], stats['cumulative'],
+                        stats['self'],
+                        1000 * stats['cumulative'] / max(stats['calls'], 1)))
+
+        return "\n".join(lines)
+
+
+@contextmanager
+def step(profiler, name):
+    # times a step of the build, if there's a profiler
+    if profiler is None:
+        yield
+    else:
+        with profiler.step(name):
+            yield
+
+
+class TimedStream(object):
+    # a stream that keeps count of the time spent writing to it
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.seconds = 0.0
+
+    def write(self, data):
+        start = timer()
+        self.stream.write(data)
+        self.seconds += timer() - start
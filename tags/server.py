@@ -0,0 +1,398 @@
+import io
+import os
+import sys
+import hashlib
+import posixpath
+import threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+if sys.version > '3':
+    import urllib.parse
+    from http.server import HTTPServer
+    from http.server import SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    import urllib
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .utils import (LRUCache, MIN_COMPRESS, compressible as _compressible, 
+                    gzip_bytes, hash_file)
+
+
+# Each connection is handled by its own thread, up to WORKERS connections at a
+# time. Connections beyond that wait in the listen queue until a worker is
+# free. A keep-alive connection that stays idle for IDLE_TIMEOUT seconds is
+# closed, so idle browsers can't hold on to all of the workers.
+
+WORKERS = 32
+IDLE_TIMEOUT = 5
+
+
+# Responses carry a strong ETag, the hash of the file's contents, and are
+# revalidated by browsers on every request, so unchanged files get a 304.
+# Text is sent compressed to clients that accept it: from a .br or .gz file
+# next to the original if the build made one, otherwise compressed once and
+# cached in memory.
+
+MAX_COMPRESS = 1 << 20
+
+_etags = LRUCache(4096)
+_compressed = LRUCache(128)
+
+
+COMPRESSORS = {'gzip': gzip_bytes}
+EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+if brotli is not None:
+    COMPRESSORS['br'] = brotli.compress
+
+
+def content_etag(content):
+    return '"' + hashlib.sha1(content).hexdigest() + '"'
+
+
+def file_etag(path, stat):
+    # hashing is done once for each version of a file
+    key = (path, stat.st_mtime, stat.st_size)
+    etag = _etags.get(key)
+    if etag is None:
+        etag = _etags[key] = '"' + hash_file(path) + '"'
+    return etag
+
+
+class _FileSlice(object):
+    # reads at most length bytes of a file, from its current position
+
+    def __init__(self, afile, length):
+        self.file = afile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class RequestHandler(SimpleHTTPRequestHandler):
+    ''' Serves the files in the server's root folder, over HTTP/1.1. '''
+
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+    # headers and body are written separately, which on a kept alive
+    # connection would wait on the client's delayed ack without this
+    disable_nagle_algorithm = True
+
+    def translate_path(self, path):
+        root = self.server.root
+
+        # normalize path and prepend root directory
+        path = path.split('?',1)[0]
+        path = path.split('#',1)[0]
+        if sys.version > '3':
+            path = posixpath.normpath(urllib.parse.unquote(path))
+        else:
+            path = posixpath.normpath(urllib.unquote(path))
+        words = path.split('/')
+        words = [_f for _f in words if _f]
+
+        path = root
+        for word in words:
+            drive, word = os.path.splitdrive(word)
+            head, word = os.path.split(word)
+            if word in (os.curdir, os.pardir):
+                continue
+            path = os.path.join(path, word)
+
+        return path
+
+    def index_path(self, path):
+        # the path of the file to send for path, which is the index.html of
+        # a folder, or None if the folder should be redirected to with a 
+        # slash or listed
+        if not os.path.isdir(path):
+            return path
+        index = os.path.join(path, 'index.html')
+        urlpath = self.path.split('?',1)[0].split('#',1)[0]
+        if not urlpath.endswith('/') or not os.path.isfile(index):
+            return None
+        return index
+
+    def send_head(self):
+        path = self.index_path(self.translate_path(self.path))
+        if path is None:
+            return SimpleHTTPRequestHandler.send_head(self)
+        return self.send_file(path)
+
+    def send_file(self, path):
+        # sends the headers for the file at path, and returns a file for 
+        # do_GET to copy the body from
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        ctype = self.guess_type(path)
+        etag = file_etag(path, stat)
+
+        encoding, body = None, path
+        if _compressible(ctype) and stat.st_size >= MIN_COMPRESS:
+            encoding, body = self.encode(etag, path=path, stat=stat)
+        return self.send_body(body, ctype, etag, stat.st_mtime, encoding)
+
+    def send_content(self, content, ctype, code=200):
+        # like send_file, for content that's bytes
+        if code != 200:
+            self.send_response(code)
+            self.send_header("Content-type", ctype)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            return io.BytesIO(content)
+
+        etag = content_etag(content)
+        encoding, body = None, content
+        if _compressible(ctype) and len(content) >= MIN_COMPRESS:
+            encoding, body = self.encode(etag, content=content)
+        return self.send_body(body, ctype, etag, None, encoding)
+
+    def accepted_encodings(self):
+        accepted = set()
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            params = item.strip().split(';')
+            quality = 1.0
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith('q='):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0
+            if quality > 0:
+                accepted.add(params[0].strip().lower())
+        return accepted
+
+    def encode(self, etag, content=None, path=None, stat=None):
+        # Returns the best encoding the client accepts, and the path of a
+        # precompressed file or the compressed bytes. The encoding is None
+        # if the content should be sent as it is.
+        accepted = self.accepted_encodings()
+        for encoding in ('br', 'gzip'):
+            if encoding not in accepted:
+                continue
+            if path is not None:
+                precompressed = path + EXTENSIONS[encoding]
+                try:
+                    if os.stat(precompressed).st_mtime >= stat.st_mtime:
+                        return encoding, precompressed
+                except OSError:
+                    pass
+            size = len(content) if content is not None else stat.st_size
+            if encoding not in COMPRESSORS or size > MAX_COMPRESS:
+                continue
+            key = (etag, encoding)
+            compressed = _compressed.get(key)
+            if compressed is None:
+                if content is None:
+                    with open(path, 'rb') as afile:
+                        content = afile.read()
+                compressed = _compressed[key] = COMPRESSORS[encoding](content)
+            return encoding, compressed
+        return None, content if content is not None else path
+
+    def not_modified(self, etag, mtime):
+        # If-Modified-Since only counts without If-None-Match
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in etags or etag in etags or 'W/' + etag in etags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None or mtime is None:
+            return False
+        try:
+            since = mktime_tz(parsedate_tz(if_modified_since))
+        except (TypeError, ValueError, OverflowError):
+            return False
+        return int(mtime) <= since
+
+    def requested_range(self, size, etag, mtime):
+        # Returns the start and end of the single byte range requested, or
+        # None to send everything. start >= end if it can't be satisfied.
+        header = self.headers.get('Range', '')
+        if not header.startswith('bytes=') or ',' in header:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range != etag and (
+                mtime is None or if_range != formatdate(mtime, usegmt=True)):
+            return None
+        first, sep, last = header[len('bytes='):].strip().partition('-')
+        try:
+            if not first:
+                start, end = max(0, size - int(last)), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+        except ValueError:
+            return None
+        if not sep or start < 0:
+            return None
+        return start, end
+
+    def send_body(self, body, ctype, etag, mtime, encoding=None):
+        # body is bytes, or the path of the file to send
+        if encoding is not None:
+            etag = etag[:-1] + '-' + encoding + '"'
+        compressible = _compressible(ctype)
+
+        if self.not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
+            self.end_headers()
+            return None
+
+        if isinstance(body, bytes):
+            size = len(body)
+            afile = io.BytesIO(body)
+        else:
+            try:
+                afile = open(body, 'rb')
+            except IOError:
+                self.send_error(404, "File not found")
+                return None
+            size = os.fstat(afile.fileno()).st_size
+
+        start, end = 0, size
+        byterange = self.requested_range(size, etag, mtime)
+        if byterange is not None:
+            start, end = byterange
+            if start >= end:
+                afile.close()
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{0}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", 
+                             "bytes {0}-{1}/{2}".format(start, end - 1, size))
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", etag)
+        if mtime is not None:
+            self.send_header("Last-Modified", formatdate(mtime, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Accept-Ranges", "bytes")
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+
+        afile.seek(start)
+        if end - start == size:
+            return afile
+        return _FileSlice(afile, end - start)
+
+
+class PreviewHandler(RequestHandler):
+    ''' Serves the server's site, a generator.MemorySite, from its source 
+    folder. Pages are rendered when they're requested, other files are sent
+    as they are. '''
+
+    def send_head(self):
+        site = self.server.site
+        path = self.translate_path(self.path)
+        # excluded folders aren't listed either
+        if os.path.isdir(path) and site.excludes_folder(
+                os.path.relpath(path, self.server.root)):
+            self.send_error(404, "File not found")
+            return None
+        path = self.index_path(path)
+        if path is None:
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        filename = os.path.relpath(path, self.server.root)
+        if site.excludes(filename):
+            self.send_error(404, "File not found")
+            return None
+        if not site.renders(filename) or not os.path.isfile(path):
+            return self.send_file(path)
+
+        error, content = site.render(filename)
+        if error:
+            self.log_error("%s", error)
+            return self.send_content(error.encode('utf-8'), 
+                                     'text/plain; charset=utf-8', code=500)
+        return self.send_content(content, self.guess_type(path))
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    ''' An HTTP server that handles at most workers connections at once. '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, handler, root='.', workers=WORKERS, 
+                 site=None):
+        HTTPServer.__init__(self, address, handler)
+        self.root = os.path.abspath(root)
+        self.site = site
+        self._workers = threading.BoundedSemaphore(workers)
+
+    def process_request(self, request, client_address):
+        self._workers.acquire()
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except:
+            self._workers.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            self._workers.release()
+
+
+def start_server(root='.', port=8000, workers=WORKERS, handler=RequestHandler,
+                 site=None):
+    ''' Serves the files in root from a background thread.
+
+    Returns the server, call stop_server with it to shut it down. A site is
+    needed by PreviewHandler.
+    '''
+    httpd = ThreadedHTTPServer(('', port), handler, root=root,
+                               workers=workers, site=site)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    httpd.thread = thread
+    return httpd
+
+
+def stop_server(httpd):
+    # stops accepting connections and waits for the serving thread to exit,
+    # requests in progress are finished by their own threads
+    httpd.shutdown()
+    httpd.server_close()
+    httpd.thread.join()
@@ -1,9 +1,41 @@
 import os
-import sys
 
-from .templatelang import TemplateLanguage
+from . import utils
+from .templatelang import TemplateLanguage, TemplateText, Context
+
+lang = TemplateLanguage(openseq='{%', closeseq='%}', reparse=False,
+                        engine='scanner')
+
+# Partials are cached by path, and reloaded when their size or mtime changes.
+# Their output is cached by path and the values of the context keys they read
+# when last rendered, along with the partials they include.
+
+source_cache = utils.LRUCache(256)
+output_cache = utils.LRUCache(4096)
+
+
+def _load_partial(fullpath, signature):
+    partial = source_cache.get(fullpath)
+    if partial is None or partial['signature'] != signature:
+        with utils.open_file(fullpath) as infile:
+            template = lang.compile(infile.read().decode('utf-8'))
+        partial = {'signature': signature, 'template': template, 'keys': None}
+        source_cache[fullpath] = partial
+    return partial
+
+
+def _output_key(fullpath, partial, context):
+    if partial['keys'] is None:
+        return None
+    # the keys are part of it, since they change with the output recorded
+    values = tuple(context.get(key) for key in partial['keys'])
+    key = (fullpath, partial['signature'], partial['keys'], values)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
-lang = TemplateLanguage(openseq='{%', closeseq='%}')
 
 @lang.add_tag
 def include(path, context={}):
@@ -12,11 +44,27 @@ def include(path, context={}):
     to the site's root folder. Ex: {% include nav.html %}
     '''
     fullpath = os.path.join(context.get('rootdir'), path)
-    if sys.version > '3':
-        stuff = str(open(fullpath).read(), 'utf-8')
-    else:
-        stuff = unicode(open(fullpath).read(), 'utf-8')
-    return stuff
+    partial = _load_partial(fullpath, utils.file_signature(fullpath))
+    context.add_file(fullpath)
+
+    key = _output_key(fullpath, partial, context)
+    cached = output_cache.get(key) if key else None
+    if cached:
+        output, files = cached
+        if all(utils.file_signature(f) == sig for f, sig in files):
+            for f, sig in files:
+                context.add_file(f)
+            return output
+
+    with context.track() as deps:
+        output = lang.expand(partial['template'], context)
+    partial['keys'] = tuple(sorted(deps.keys))
+    key = _output_key(fullpath, partial, context)
+    if key:
+        files = tuple((f, utils.file_signature(f))
+                      for f in sorted(deps.files))
+        output_cache[key] = (output, files)
+    return output
 
 
 @lang.add_tag_with_name('is')
@@ -45,7 +93,16 @@ def _is(path, body='', context={}):
 
 # - positional arguments define the tag's required arguments.
 # - If you specify a `body` keyword argument, then the tag will require a body.
+#   The body is rendered before the tag function is called.
 # - All tag functions must accept a `context` keyword argument. 
+# - The result of a tag is used as is. To have template code in the result
+#   rendered, return it wrapped in `TemplateText`.
+
+# A tag whose result is template code, which is rendered in turn:
+
+# @lang.add_tag
+# def sidebar(name, context={}):
+#     return TemplateText(u'{% include _sidebars/' + name + u'.html %}')
 
 # You can also define tags that accept a variable argument list like so:
 
@@ -54,10 +111,51 @@ def _is(path, body='', context={}):
 #     return str(len(args))
 
 
-def render(content, filename='', rootdir='.'):
+def render(content, filename='', rootdir='.', dependencies=None):
     ''' 
     Renders a content string containing template code into an output string. 
     Uses the tags specified above. Filename and rootdir are added to the 
-    context passed to the tag functions.
+    context passed to the tag functions. If a dependencies set is given, the
+    paths of the partials included, directly or not, are added to it.
+    '''
+    if dependencies is None:
+        return lang.parse(content, filename=filename, rootdir=rootdir)
+    context = Context(filename=filename, rootdir=rootdir)
+    with context.track() as deps:
+        output = lang.expand(lang.compile(content), context)
+    dependencies.update(deps.files)
+    return output
+
+
+def render_many(content, filenames, rootdir='.', dependencies=None):
+    '''
+    Renders a content string once for each of filenames, like render, and
+    yields the outputs in order. The content is compiled once, and the output
+    of the tags that don't depend on the filename, like the includes of
+    partials that don't use the is tag, is only rendered once. If a
+    dependencies set is given, the paths of the partials included for any of
+    the files are added to it.
+    '''
+    def _contexts():
+        # each context is tracked until the next one is asked for, which is
+        # after its output is rendered
+        for filename in filenames:
+            context = Context(filename=filename, rootdir=rootdir)
+            with context.track() as deps:
+                yield context
+            if dependencies is not None:
+                dependencies.update(deps.files)
+
+    return lang.render_many(lang.compile(content), _contexts())
+
+
+def render_to(stream, content, filename='', rootdir='.', dependencies=None):
+    ''' 
+    Like render, but writes the output to stream in chunks as it's rendered,
+    instead of returning it.
     '''
-    return lang.parse(content, filename=filename, rootdir=rootdir)
+    context = Context(filename=filename, rootdir=rootdir)
+    with context.track() as deps:
+        lang.expand_to(stream, lang.compile(content), context)
+    if dependencies is not None:
+        dependencies.update(deps.files)
@@ -0,0 +1,127 @@
+'''
+A cache of compiled templates on disk, shared by every build that uses the
+same cache folder, so a build of an unchanged site doesn't parse anything,
+even in a new process.
+
+Set TemplateLanguage.cache to a TemplateCache to use it. Each template is
+stored in a file of its own, named by a hash of the template's content and
+of everything else that decides how it compiles: the tag delimiters, the
+names of the tags, the version of tags and of Python. A template whose
+language changed is simply not found, and its old file is eventually evicted.
+
+Files are written to a temporary name and renamed, so several processes can
+share the cache. It grows past its limits until prune is called, which
+removes the least recently used files.
+'''
+
+import os
+import sys
+import marshal
+import hashlib
+
+from . import __version__
+from . import utils
+from .templatelang import Tag
+
+
+CACHE_DIR = '.tags-cache'
+
+# the default limits of the size of a cache folder, in bytes and files
+MAX_SIZE = 64 * 1024 * 1024
+MAX_FILES = 10000
+
+# changes whenever the format of the files changes
+FORMAT = 1
+
+
+def _dump(segments):
+    return marshal.dumps([
+        segment if not isinstance(segment, Tag) else
+        (segment.name, list(segment.args), segment.body, segment.loc)
+        for segment in segments])
+
+
+def _load(data):
+    return [Tag(*segment) if isinstance(segment, tuple) else segment
+            for segment in marshal.loads(data)]
+
+
+class TemplateCache(object):
+    ''' Stores the segments of compiled templates in folder. '''
+
+    def __init__(self, folder=CACHE_DIR, max_size=MAX_SIZE,
+                 max_files=MAX_FILES):
+        self.folder = folder
+        self.max_size = max_size
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lang, content_hash):
+        ''' The key of a template in the cache, from the content hash of its
+        source and the language that compiles it. '''
+        config = '\n'.join([str(FORMAT), __version__, 
+                            '{0}.{1}'.format(*sys.version_info),
+                            lang._openseq, lang._closeseq] +
+                           sorted(lang._tags))
+        return hashlib.sha1(
+            (config + '\n' + content_hash).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key):
+        ''' Returns the segments stored for key, or None. '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as infile:
+                segments = _load(infile.read())
+            # the time of the last use, for prune
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        except (EOFError, ValueError, TypeError):
+            # a damaged file is compiled again
+            self.misses += 1
+            return None
+        self.hits += 1
+        return segments
+
+    def set(self, key, segments):
+        ''' Stores the segments of a compiled template for key. '''
+        path = self._path(key)
+        tmpfilename = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with utils.open_file(tmpfilename, 'wb', create_dir=True) as outfile:
+                outfile.write(_dump(segments))
+            utils.replace_file(tmpfilename, path)
+        except (IOError, OSError, ValueError):
+            # the cache is only an optimization
+            try:
+                os.remove(tmpfilename)
+            except OSError:
+                pass
+
+    def prune(self):
+        ''' Removes the least recently used files until the cache is within
+        its limits. Returns the number of files removed. '''
+        files = []
+        for entry in utils.scan_folder(self.folder):
+            try:
+                result = entry.stat()
+            except OSError:
+                continue
+            files.append((result.st_mtime, result.st_size, entry.path))
+        files.sort(reverse=True)
+        size = 0
+        removed = 0
+        for count, (mtime, filesize, path) in enumerate(files):
+            size += filesize
+            if size > self.max_size or count >= self.max_files:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
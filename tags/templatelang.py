@@ -1,11 +1,64 @@
-from pyparsing import *
+from bisect import bisect_left
+from contextlib import contextmanager
+import hashlib
 import inspect
+import re
+import sys
+
+from .utils import LRUCache
+
+try:
+    _getargspec = inspect.getfullargspec
+except AttributeError:
+    _getargspec = inspect.getargspec
+
+# async tags and parse_async need Python 3.7, see asyncrender
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', 
+                               lambda fn: False)
+_iscoroutine = getattr(inspect, 'iscoroutine', lambda obj: False)
 
 
 # -----------------------------------------------------------------------------
 # Exceptions
 # -----------------------------------------------------------------------------
 
+# pyparsing is only imported by the pyparsing engine, when a template is first
+# compiled with it. Parse errors are raised as a ParseBaseException of this
+# module, which has the same attributes as pyparsing's.
+
+class ParseBaseException(Exception):
+    def __init__(self, pstr, loc=0, msg=None, elem=None):
+        if msg is None:
+            msg, pstr = pstr, ''
+        self.loc = loc
+        self.msg = msg
+        self.pstr = pstr
+        self.parser_element = elem
+        self.args = (pstr, loc, msg)
+
+    @property
+    def line(self):
+        start = self.pstr.rfind('\n', 0, self.loc) + 1
+        end = self.pstr.find('\n', self.loc)
+        return self.pstr[start:] if end == -1 else self.pstr[start:end]
+
+    @property
+    def lineno(self):
+        return self.pstr.count('\n', 0, self.loc) + 1
+
+    @property
+    def col(self):
+        if 0 < self.loc < len(self.pstr) and self.pstr[self.loc-1] == '\n':
+            return 1
+        return self.loc - self.pstr.rfind('\n', 0, self.loc)
+
+    column = col
+
+    def __str__(self):
+        return "{0}  (at char {1}), (line:{2}, col:{3})".format(
+            self.msg, self.loc, self.lineno, self.col)
+
+
 class TagErrorArguments(Exception):
     def __init__(self, tagname, nargs, args):
         params = (tagname, nargs, " ".join(args))
@@ -28,6 +81,26 @@ class TagErrorBody(Exception):
         return self.msg
 
 
+class TagErrorCycle(Exception):
+    def __init__(self, tagname, args):
+        params = (" ".join([tagname] + list(args)),)
+        errstr = "tag '{0}' expands to itself"
+        self.msg = errstr.format(*params)
+
+    def __str__(self):
+        return self.msg
+
+
+class TagErrorDepth(Exception):
+    def __init__(self, tagname, max_depth):
+        params = (tagname, max_depth)
+        errstr = "tag '{0}' is nested more than {1} levels deep"
+        self.msg = errstr.format(*params)
+
+    def __str__(self):
+        return self.msg
+
+
 class TagErrorException(ParseBaseException):
     def __init__(self, parsestr, loc, exc, dev=False):
         if dev:
@@ -42,16 +115,258 @@ class TagErrorException(ParseBaseException):
 # Functions
 # -----------------------------------------------------------------------------
 
+def content_hash(string):
+    ''' Returns the key used to cache compiled templates. '''
+    return hashlib.sha1(string.encode('utf-8')).hexdigest()
+
+
 def debug_action(name=''):
     def _wrapped(parsestr, loc, tokens):
         print(name, ": ", parsestr[0:loc], '*', parsestr[loc:], "-->", tokens)
     return _wrapped
 
 
+# -----------------------------------------------------------------------------
+# Scanner
+# -----------------------------------------------------------------------------
+
+# The scanner engine matches the same language as the pyparsing grammar, so
+# these mirror pyparsing's default whitespace, keyword chars and quotedString.
+
+_WHITESPACE = re.compile(r'[ \n\t\r]*')
+_KEYWORDCHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$')
+_QUOTED = re.compile(r'(?:"(?:[^"\n\r\\]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*")|'
+                     r"(?:'(?:[^'\n\r\\]|(?:'')|(?:\\x[0-9a-fA-F]+)|(?:\\.))*')")
+_UNQUOTED = re.compile(r'[^ \t\r\n]+')
+
+
+def _skip_whitespace(string, loc):
+    return _WHITESPACE.match(string, loc).end()
+
+
+def _find_all(string, seq):
+    found = []
+    loc = string.find(seq)
+    while loc != -1:
+        found.append(loc)
+        loc = string.find(seq, loc + 1)
+    return found
+
+
+def _match_keyword(string, loc, keyword):
+    ''' Matches a caseless keyword at loc. Returns its end, or -1. '''
+    end = loc + len(keyword)
+    if string[loc:end].upper() != keyword.upper():
+        return -1
+    if end < len(string) and string[end].upper() in _KEYWORDCHARS:
+        return -1
+    if loc > 0 and string[loc-1].upper() in _KEYWORDCHARS:
+        return -1
+    return end
+
+
+def _split_args(rawargs):
+    ''' Splits the text between a tag's name and the close sequence into
+    arguments. Quoted arguments may contain whitespace.
+    '''
+    rawargs = rawargs.expandtabs()
+    args = []
+    loc = 0
+    while True:
+        loc = _skip_whitespace(rawargs, loc)
+        match = _QUOTED.match(rawargs, loc)
+        if match:
+            args.append(match.group()[1:-1])
+        else:
+            match = _UNQUOTED.match(rawargs, loc)
+            if not match:
+                return args
+            args.append(match.group())
+        loc = match.end()
+
+
+# -----------------------------------------------------------------------------
+# Pyparsing
+# -----------------------------------------------------------------------------
+
+def _tag_name(lang):
+    ''' Returns a pyparsing element that matches the name of any of the tags
+    of lang, with a dict lookup instead of trying each name in turn. '''
+    from pyparsing import ParseException, Token
+
+    class TagName(Token):
+        def __init__(self):
+            Token.__init__(self)
+            self.errmsg = "Expected tag name"
+            self.mayReturnEmpty = False
+            self.mayIndexError = False
+
+        def parseImpl(self, instring, loc, doActions=True):
+            name, end = lang._match_name(instring, loc)
+            if name is None:
+                raise ParseException(instring, loc, self.errmsg, self)
+            return end, name
+
+    return TagName()
+
+
+@contextmanager
+def _packrat():
+    ''' Turns on pyparsing's packrat memoization, which is global to pyparsing,
+    and turns it off again afterwards unless it was already on. '''
+    from pyparsing import ParserElement
+    if ParserElement._packratEnabled:
+        yield
+        return
+    ParserElement.enablePackrat()
+    try:
+        yield
+    finally:
+        if hasattr(ParserElement, 'disable_memoization'):
+            ParserElement.disable_memoization()
+        else:
+            ParserElement.resetCache()
+            ParserElement._parse = ParserElement._parseNoCache
+            ParserElement._packratEnabled = False
+
+
 # -----------------------------------------------------------------------------
 # Classes
 # -----------------------------------------------------------------------------
 
+ENGINES = ('pyparsing', 'scanner')
+
+if sys.version > '3':
+    _text = str
+else:
+    _text = unicode
+
+
+class TemplateText(_text):
+    ''' A string returned by a tag function that contains template code.
+
+    Unless the language reparses all tag output, the output of a tag is used
+    as is. Tags that return template code, like the contents of a partial,
+    should wrap it in TemplateText to have it rendered.
+    '''
+
+
+class Dependencies(object):
+    ''' The context keys and files that rendered output depends on. '''
+
+    def __init__(self):
+        self.keys = set()
+        self.files = set()
+
+
+class Context(dict):
+    ''' The context passed to tag functions.
+
+    Holds the keyword arguments given to parse or render. Also keeps the
+    stack of tags being expanded, to catch tags that expand to themselves,
+    and can record what the output of tags depends on, see track.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(Context, self).__init__(*args, **kwargs)
+        self.stack = []
+        self._tracking = []
+
+    def _read(self, key):
+        for deps in self._tracking:
+            deps.keys.add(key)
+
+    def _read_all(self):
+        for deps in self._tracking:
+            deps.keys.update(dict.keys(self))
+
+    def __getitem__(self, key):
+        self._read(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self._read(key)
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._read_all()
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        self._read(key)
+        return dict.get(self, key, default)
+
+    def keys(self):
+        self._read_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._read_all()
+        return dict.values(self)
+
+    def items(self):
+        self._read_all()
+        return dict.items(self)
+
+    def add_file(self, path):
+        ''' Records that the output being rendered depends on a file. '''
+        for deps in self._tracking:
+            deps.files.add(path)
+
+    @contextmanager
+    def track(self):
+        ''' Records the dependencies of the output rendered in a with block.
+
+        Yields a Dependencies object, which collects the keys read from the
+        context and the files added with add_file, by any tag rendered in the
+        block. Useful for caching output that depends on the context.
+        '''
+        deps = Dependencies()
+        self._tracking.append(deps)
+        try:
+            yield deps
+        finally:
+            self._tracking.pop()
+
+
+class Tag(object):
+    ''' A tag in a compiled template. 
+
+    Holds the tag's name and arguments, its body, or None if it doesn't have
+    one, and its location in the template string.
+    '''
+
+    __slots__ = ('name', 'args', 'body', 'loc')
+
+    def __init__(self, name, args, body=None, loc=0):
+        self.name = name
+        self.args = args
+        self.body = body
+        self.loc = loc
+
+    def __repr__(self):
+        return "Tag({0!r}, {1!r}, {2!r}, {3!r})".format(
+            self.name, self.args, self.body, self.loc)
+
+
+class Template(object):
+    ''' A compiled template string. 
+
+    Segments is a list of the literal strings and Tag objects in the template,
+    in order. Rendering a template only calls the tag functions, the source
+    string is kept for error messages.
+    '''
+
+    __slots__ = ('source', 'segments')
+
+    def __init__(self, source, segments):
+        self.source = source
+        self.segments = segments
+
+    def __repr__(self):
+        return "Template({0!r})".format(self.segments)
+
+
 class TemplateLanguage(object):
     ''' A generic tag-based language supporting nested tags. 
 
@@ -90,9 +405,12 @@ class TemplateLanguage(object):
         closing tag.
 
         Tag argument checking won't happen if the development flag is set.
+
+        The function can also be a coroutine function, an async def, see
+        parse_async. It's run to completion when rendering synchronously.
         '''
         def _decorator(fn):
-            posargs, varargs, varkwargs, defaults = inspect.getargspec(fn)
+            posargs, varargs, varkwargs, defaults = _getargspec(fn)[:4]
             req_body = "body" in posargs
             nargs = len(posargs)
             if "context" in posargs:
@@ -100,16 +418,29 @@ class TemplateLanguage(object):
             if req_body:
                 nargs -= 1
 
-            def _wrapper(*args, **kwargs):
+            def _check(args, kwargs):
                 if not self._development:
                     if (varargs and len(args) < nargs) or len(args) != nargs:
                         raise TagErrorArguments(name, nargs, args)
                     has_body = 'body' in kwargs
                     if has_body != req_body:
                         raise TagErrorBody(name, req_body, has_body)
-                return fn(*args, **kwargs)
+
+            def _wrapper(*args, **kwargs):
+                _check(args, kwargs)
+                if self.profiler is None:
+                    return fn(*args, **kwargs)
+                with self.profiler.tag(name):
+                    return fn(*args, **kwargs)
+
+            if _iscoroutinefunction(fn):
+                from .asyncrender import tag_wrapper
+                _wrapper = tag_wrapper(self, name, fn, _check)
 
             self._tags[name] = _wrapper
+            self._keywords = None
+            self._parser = None
+            self._templates.clear()
 
             return _wrapper
         return _decorator
@@ -131,63 +462,302 @@ class TemplateLanguage(object):
 
     # language specification --------------------------------------------------
 
-    def _mkopentag(self, name):
-        tagname = CaselessKeyword(name)
-        quote = quotedString.setParseAction(removeQuotes)
+    def _mkparser(self):
+        # Every tag is matched by the same rule, which looks its name up like
+        # the scanner does. A tag with a body only matches if its close tag 
+        # is the end tag of the same name, otherwise it matches without one.
+        from pyparsing import (CharsNotIn, Combine, Forward, Group, Literal,
+                               OneOrMore, Optional, ParseException, SkipTo,
+                               White, ZeroOrMore, originalTextFor, 
+                               quotedString, removeQuotes)
+
+        tagopen = Literal(self._openseq).suppress()
+        tagclose = Literal(self._closeseq).suppress()
+
+        quote = quotedString.copy().setParseAction(removeQuotes)
         arg = Optional(White()).suppress() + CharsNotIn(" \t\r\n")
         args = Group(ZeroOrMore(quote | arg))
-        rawargs = SkipTo(self._tagclose)
+        rawargs = SkipTo(tagclose)
         rawargs.setParseAction(lambda toks: args.parseString(toks[0]))
-        return self._tagopen + tagname + rawargs + self._tagclose
-
-
-    def _mkclosetag(self, name):
-        tagname = CaselessKeyword("end"+name)
-        return self._tagopen + tagname.suppress() + self._tagclose
-
-
-    def _mktag(self, name, body):
-        opentag = self._mkopentag(name)
-        closetag = self._mkclosetag(name)
-        tag = opentag + body + closetag | opentag
-        return tag
+        opentag = tagopen + _tag_name(self) + rawargs + tagclose
+        closetag = tagopen + SkipTo(tagclose) + tagclose
 
+        def _check_close(parsestr, loc, tokens):
+            name, closename = tokens[0], tokens[-1]
+            if closename.strip(' \t\r\n').upper() != "END" + name.upper():
+                raise ParseException(parsestr, loc, "expected end" + name)
+            del tokens[-1]
 
-    def _mkparser(self, tags):
         onechar = CharsNotIn('', exact=1)
-        freetext = Combine(OneOrMore(~self._tagopen + ~self._tagclose + onechar))
+        freetext = Combine(OneOrMore(~tagopen + ~tagclose + onechar))
         anytag = Forward()
         body = originalTextFor(ZeroOrMore(anytag | freetext))
-        anytag << MatchFirst([self._mktag(key, body) for key in list(tags.keys())])
+        block = (opentag + body + closetag).setParseAction(_check_close)
+        anytag << (block | opentag)
+        # tag locations must refer to the string as given
+        anytag.keepTabs = True
         return anytag
 
 
-    def _mkparsefn(self, context):
-        def _parsefn(parsestr, loc, tokens):
+    def _scan_pyparsing(self, string):
+        if not self._parser:
+            self._parser = self._mkparser()
+        if self._packrat:
+            # the memoization is only on while this language scans, so that
+            # it doesn't change how other grammars in the process parse
+            with _packrat():
+                matches = list(self._parser.scanString(string))
+        else:
+            matches = self._parser.scanString(string)
+        for tokens, start, end in matches:
             name, parseresult = tokens[:2]
-            args = parseresult.asList()
-            try:
-                fn = self._tags[name]
-            except KeyError:
-                # This should never be reached since the parser 
-                # won't match a tag that's not in the list
-                raise
-            kwargs = {'context': context}
-            if len(tokens) > 2:
-                kwargs.update({'body': tokens[2]})
+            body = tokens[2] if len(tokens) > 2 else None
+            yield start, end, name, parseresult.asList(), body
+
+
+    def _call_tag(self, parsestr, tag, context):
+        return "".join(self._generate_tag(parsestr, tag, context))
+
+
+    def _generate_tag(self, parsestr, tag, context):
+        # yields the output of a tag in chunks, which are the chunks of the
+        # rendered result if the tag's output needs rendering
+        fn = self._tags[tag.name]
+        kwargs = {'context': context}
+        if tag.body is not None:
+            if self._reparse:
+                kwargs.update({'body': tag.body})
+            else:
+                body = self._render(self.compile(tag.body), context)
+                kwargs.update({'body': body})
+        # a tag called with the same arguments while it's being expanded
+        # would expand forever
+        key = (tag.name, tuple(tag.args), tag.body)
+        context.stack.append(key)
+        try:
             try:
-                processed = fn(*args, **kwargs)
+                if key in context.stack[:-1]:
+                    raise TagErrorCycle(tag.name, tag.args)
+                if len(context.stack) > self._max_depth:
+                    raise TagErrorDepth(tag.name, self._max_depth)
+                processed = fn(*tag.args, **kwargs)
+                if _iscoroutine(processed):
+                    from .asyncrender import run
+                    processed = run(processed)
             except ParseBaseException:
                 raise
             except Exception as e:
-                raise TagErrorException(parsestr, loc, e, self._development)
-            return self.parse(processed, **context)
-        return _parsefn
+                raise TagErrorException(parsestr, tag.loc, e, self._development)
+            if self._reparse or isinstance(processed, TemplateText):
+                if self._openseq in processed:
+                    template = self.compile(processed)
+                    for chunk in self._generate(template, context):
+                        yield chunk
+                    return
+            yield processed
+        finally:
+            context.stack.pop()
+
+
+    # scanner engine ----------------------------------------------------------
+
+    def _mkkeywords(self, tags):
+        # names made of keyword chars are looked up using the word that
+        # follows the open sequence, any other names are tried in turn
+        keywords, irregular = {}, []
+        for index, name in enumerate(tags):
+            if all(c.upper() in _KEYWORDCHARS for c in name):
+                keywords.setdefault(name.upper(), (index, name))
+            else:
+                irregular.append((index, name))
+        return keywords, irregular
+
+
+    def _match_name(self, string, loc):
+        if loc > 0 and string[loc-1].upper() in _KEYWORDCHARS:
+            return None, -1
+        if self._keywords is None:
+            self._keywords = self._mkkeywords(self._tags)
+        keywords, irregular = self._keywords
+
+        end = loc
+        while end < len(string) and string[end].upper() in _KEYWORDCHARS:
+            end += 1
+        found = keywords.get(string[loc:end].upper())
+        if found:
+            found += (end,)
+        for index, name in irregular:
+            if found and found[0] < index:
+                break
+            nameend = _match_keyword(string, loc, name)
+            if nameend != -1:
+                found = (index, name, nameend)
+                break
+        if not found:
+            return None, -1
+        return found[1:]
+
+
+    def _match_closetag(self, string, loc, name):
+        loc = _skip_whitespace(string, loc)
+        if not string.startswith(self._openseq, loc):
+            return -1
+        loc = _skip_whitespace(string, loc + len(self._openseq))
+        loc = _match_keyword(string, loc, "end"+name)
+        if loc == -1:
+            return -1
+        loc = _skip_whitespace(string, loc)
+        if not string.startswith(self._closeseq, loc):
+            return -1
+        return loc + len(self._closeseq)
+
+
+    def _scan(self, string):
+        ''' Finds the top level tags in a template string.
+
+        Yields (start, end, name, args, body) for each tag, where body is None
+        if the tag doesn't have one. Matches the same tags as the pyparsing
+        grammar, but only visits the locations of open and close sequences.
+        These are visited from last to first, so the body of a tag can skip
+        over the tags nested in it instead of matching them again.
+        '''
+        opens = _find_all(string, self._openseq)
+        if not opens:
+            return
+        closes = _find_all(string, self._closeseq)
+        marks = sorted(set(opens).union(closes))
+        lenopen, lenclose = len(self._openseq), len(self._closeseq)
+
+        # tags maps the location of each tag to its end, name, argument span
+        # and body span. stops maps each mark to the end of a body reaching it
+        tags = {}
+        stops = {}
+
+        def _body_end(loc):
+            # a body is a sequence of tags and free text, which ends before
+            # the first open or close sequence that doesn't start a tag, and
+            # before any whitespace leading up to it
+            start = _skip_whitespace(string, loc)
+            if start in tags:
+                return stops[start]
+            i = bisect_left(marks, start)
+            if i == len(marks):
+                return len(string) if start < len(string) else loc
+            return stops[marks[i]] if marks[i] > start else loc
+
+        def _match_tag(loc):
+            loc = _skip_whitespace(string, loc + lenopen)
+            name, loc = self._match_name(string, loc)
+            if name is None:
+                return None
+            argstart = _skip_whitespace(string, loc)
+            i = bisect_left(closes, argstart)
+            if i == len(closes):
+                return None
+            argend = closes[i]
+            openend = argend + lenclose
+            bodystart = _skip_whitespace(string, openend)
+            bodyend = _body_end(bodystart)
+            end = self._match_closetag(string, bodyend, name)
+            if end == -1:
+                return openend, name, (argstart, argend), None
+            return end, name, (argstart, argend), (bodystart, bodyend)
+
+        for loc in reversed(marks):
+            tag = None
+            if string.startswith(self._openseq, loc):
+                tag = _match_tag(loc)
+            if tag:
+                tags[loc] = tag
+                stops[loc] = _body_end(tag[0])
+            else:
+                stops[loc] = loc
+
+        last = 0
+        for start in opens:
+            if start < last or start not in tags:
+                continue
+            end, name, argspan, bodyspan = tags[start]
+            args = _split_args(string[argspan[0]:argspan[1]])
+            body = string[bodyspan[0]:bodyspan[1]] if bodyspan else None
+            yield start, end, name, args, body
+            last = end
+
+
+    # compiled templates ------------------------------------------------------
+
+    def _compile(self, string):
+        if self._engine == 'scanner':
+            scan = self._scan
+        else:
+            scan = self._scan_pyparsing
+        segments = []
+        last = 0
+        for start, end, name, args, body in scan(string):
+            if start > last:
+                segments.append(string[last:start])
+            segments.append(Tag(name, args, body, start))
+            last = end
+        if last < len(string):
+            segments.append(string[last:])
+        return Template(string, segments)
+
+
+    def _generate(self, template, context):
+        for segment in template.segments:
+            if isinstance(segment, Tag):
+                for chunk in self._generate_tag(template.source, segment, 
+                                                context):
+                    yield chunk
+            else:
+                yield segment
+
+
+    def _generate_shared(self, template, context, shared):
+        # shared maps the index of each tag in the template to the context
+        # keys its output depends on, and its outputs, and the files they
+        # depend on, by the values of those keys
+        for index, segment in enumerate(template.segments):
+            if not isinstance(segment, Tag):
+                yield segment
+                continue
+            entry = shared.get(index)
+            if entry is not None:
+                keys, outputs = entry
+                values = tuple(context.get(key) for key in keys)
+                try:
+                    found = outputs.get(values)
+                except TypeError:
+                    found = None
+                if found is not None:
+                    output, files = found
+                    for path in files:
+                        context.add_file(path)
+                    yield output
+                    continue
+
+            with context.track() as deps:
+                output = self._call_tag(template.source, segment, context)
+            keys = tuple(sorted(deps.keys))
+            if entry is None or entry[0] != keys:
+                entry = shared[index] = (keys, {})
+            try:
+                values = tuple(context.get(key) for key in keys)
+                entry[1][values] = (output, tuple(deps.files))
+            except TypeError:
+                pass
+            yield output
+
+
+    def _render(self, template, context):
+        return "".join(self._generate(template, context))
 
 
     # public methods ----------------------------------------------------------
 
-    def __init__(self, tags=None, openseq='{%', closeseq='%}', development=False):
+    def __init__(self, tags=None, openseq='{%', closeseq='%}', development=False,
+                 engine='pyparsing', cache_size=512, reparse=True,
+                 max_depth=100, packrat=False, concurrency=10):
         ''' Creates a new template language instance.
 
         If the tag keyword argument isn't provided, tags should be created
@@ -196,19 +766,46 @@ class TemplateLanguage(object):
 
         If the development flag is set, tag argument checking is disabled and
         errors will include a stack trace.
+
+        The engine is either 'pyparsing' or 'scanner'. Both parse the same
+        language, but the scanner finds tags in a single pass over the
+        string, which is much faster for large templates. With packrat set,
+        the pyparsing engine turns on pyparsing's packrat memoization while
+        it parses.
+
+        Up to cache_size compiled templates are kept, see compile.
+
+        If reparse is set, tag bodies are passed to the tag functions as is,
+        and the output of each tag is parsed again. Otherwise tag bodies are
+        rendered before calling the tag, and the output of a tag is only 
+        rendered if it's TemplateText. Either way, a tag that expands to 
+        itself, or tags nested more than max_depth levels deep, are errors.
+
+        parse_async calls up to concurrency tag functions at the same time.
         '''
+        if engine not in ENGINES:
+            raise ValueError("unknown parsing engine '{0}', should be one of "
+                             "{1}".format(engine, ", ".join(ENGINES)))
         self._tags = {}
+        self._keywords = None
         self._development = development
+        self._engine = engine
         self._openseq = openseq
-        self._tagopen = Literal(openseq).suppress()
-        self._tagclose = Literal(closeseq).suppress()
+        self._closeseq = closeseq
+        self._parser = None
+        self._packrat = packrat
+        self._concurrency = concurrency
+        self._templates = LRUCache(cache_size)
+        self._reparse = reparse
+        self._max_depth = max_depth
+        # a profiling.Profiler, to record the calls and time of each tag
+        self.profiler = None
+        # a templatecache.TemplateCache, to keep compiled templates on disk
+        self.cache = None
 
         if tags:
             for name, fn in tags.items():
                 self.add_tag_with_name(name)(fn)
-            self._parser = self._mkparser(self._tags)
-        else:
-            self._parser = None
 
 
     def parse(self, string, **context):
@@ -219,12 +816,135 @@ class TemplateLanguage(object):
         will be added to the context passed to the tag functions.
         '''
         if self._openseq in string:
-            if not self._parser:
-                self._parser = self._mkparser(self._tags)
-            parsefn = self._mkparsefn(context.copy())
-            parser = self._parser.copy()
-            parser.setParseAction(parsefn)
-            return parser.transformString(string)
+            return self._render(self.compile(string), Context(context))
         else:
             return string
 
+
+    def contains_tags(self, content):
+        ''' Whether a string, or its utf-8 encoding, may contain tags.
+
+        If it doesn't, parsing or rendering it returns it unchanged. 
+        '''
+        if isinstance(content, bytes):
+            return self._openseq.encode('utf-8') in content
+        return self._openseq in content
+
+
+    def parse_async(self, string, **context):
+        ''' Like parse, but returns a coroutine, and the tags are called
+        concurrently.
+
+        The tags of the template, and of the templates they render, are 
+        called at the same time, up to the concurrency of the language, and
+        async tag functions are awaited. The result is the same as parse's,
+        as long as tag functions don't change the context, since tags that
+        run at the same time each get their own copy. Needs Python 3.7.
+        '''
+        from .asyncrender import render
+        return render(self, self.compile(string), Context(context),
+                      self._concurrency)
+
+
+    def compile(self, string):
+        ''' Compiles a template string into a Template.
+
+        The template can be rendered any number of times without parsing the
+        string again. Compiled templates are cached by the hash of their 
+        content, so compiling a string that was compiled before, like a 
+        partial shared by many pages, returns the cached template. With a
+        cache, templates that aren't in memory are looked up on disk before
+        they're parsed.
+        '''
+        if self._openseq not in string:
+            return Template(string, [string] if string else [])
+        key = content_hash(string)
+        template = self._templates.get(key)
+        if template is None:
+            if self.cache is None:
+                template = self._compile(string)
+            else:
+                diskkey = self.cache.key(self, key)
+                segments = self.cache.get(diskkey)
+                if segments is None:
+                    template = self._compile(string)
+                    self.cache.set(diskkey, template.segments)
+                else:
+                    template = Template(string, segments)
+            self._templates[key] = template
+        return template
+
+
+    def render(self, template, **context):
+        ''' Renders a compiled template. 
+
+        Like parse, calls the tag functions and replaces each tag with its
+        result. Keyword arguments are added to the context passed to the tag
+        functions.
+        '''
+        return self._render(template, Context(context))
+
+
+    def render_many(self, template, contexts):
+        ''' Renders a compiled template, or a template string, once for each
+        of contexts, and yields the outputs in order.
+
+        Contexts are dicts of the keyword arguments that would be given to
+        render, or Contexts. Each tag is rendered while recording the context
+        keys it reads, and its output is reused for the following contexts
+        that have the same values for those keys. So tags that don't read the
+        context are called once, and the others once per distinct value. Tag
+        functions should return the same output given the same arguments and
+        context values.
+        '''
+        if not isinstance(template, Template):
+            template = self.compile(template)
+        shared = {}
+        for context in contexts:
+            if not isinstance(context, Context):
+                context = Context(context)
+            yield "".join(self._generate_shared(template, context, shared))
+
+
+    def generate(self, template, **context):
+        ''' Renders a compiled template, or a template string, in chunks.
+
+        Returns an iterator over the chunks of output: the text between tags
+        and the output of each tag, in order. Joined they're the same as the
+        result of render. Tags are called as the chunks are consumed.
+        '''
+        if not isinstance(template, Template):
+            template = self.compile(template)
+        return self._generate(template, Context(context))
+
+
+    def render_to(self, stream, template, **context):
+        ''' Renders a compiled template, or a template string, into stream.
+
+        Chunks of output are written to the stream as they're rendered, so
+        the whole output is never held in memory at once.
+        '''
+        self.expand_to(stream, template, Context(context))
+
+
+    def expand(self, template, context):
+        ''' Renders a compiled template from within a tag function.
+
+        Context should be the context passed to the tag function. Tags in the
+        template are then checked for cycles and nesting depth along with the
+        tag being expanded.
+        '''
+        if not isinstance(context, Context):
+            context = Context(context)
+        return self._render(template, context)
+
+
+    def expand_to(self, stream, template, context):
+        ''' Like expand, but writes the output to stream in chunks. '''
+        if not isinstance(template, Template):
+            template = self.compile(template)
+        if not isinstance(context, Context):
+            context = Context(context)
+        for chunk in self._generate(template, context):
+            stream.write(chunk)
+
@@ -1,24 +1,136 @@
+import io
 import os
-import fnmatch
+import re
+import sys
+import stat
 import shutil
+import hashlib
+import threading
+from collections import OrderedDict
 
 
-def print_parse_exception(exc, filename=None):
+def format_parse_exception(exc, filename=None):
     msg = "Parse Error "
     if filename:
         msg += "while compiling {0}".format(filename)
     msg += ": " + exc.msg + "\n"
     msg += exc.line + "\n"
     msg += " "*(exc.column-1) + "^"
-    print(msg)
+    return msg
+
+
+def print_parse_exception(exc, filename=None):
+    print(format_parse_exception(exc, filename))
+
+
+class FileEntry(object):
+    ''' A file found by scan_folder.
+
+    Holds the file's path relative to the folder scanned, and its full path.
+    The stat result is fetched the first time it's asked for, and kept, so
+    a build stats each file once. Where the folder was read with scandir,
+    the stat comes from the directory entry, which is free on Windows.
+    '''
+
+    __slots__ = ('name', 'path', '_entry', '_stat')
+
+    def __init__(self, name, path, entry=None):
+        self.name = name
+        self.path = path
+        self._entry = entry
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            if self._entry is not None:
+                self._stat = self._entry.stat()
+            else:
+                self._stat = os.stat(self.path)
+        return self._stat
 
+    def signature(self):
+        return stat_signature(self.stat())
 
-def walk_folder(root='.'):
-    for subdir, dirs, files in os.walk(root):
-        reldir = subdir[len(root):] if subdir.startswith(root) else subdir
-        reldir = reldir.lstrip('/')
-        for filename in files:
-            yield os.path.join(reldir, filename)
+
+def _list_folder(folder):
+    # the files and folders in folder, as (name, is_folder, is_link, entry)
+    if hasattr(os, 'scandir'):
+        return [(entry.name, entry.is_dir(), entry.is_symlink(), entry)
+                for entry in list(os.scandir(folder))]
+    return [(name, 
+             os.path.isdir(os.path.join(folder, name)), 
+             os.path.islink(os.path.join(folder, name)),
+             None)
+            for name in os.listdir(folder)]
+
+
+def scan_folder(root='.', exclude=None):
+    ''' Yields a FileEntry for each file in root and its subfolders. 
+    
+    Each folder is read once, with os.scandir where it's available, and 
+    folders whose contents the GlobPattern exclude excludes entirely aren't
+    read at all. Like os.walk, symbolic links to folders aren't followed.
+    '''
+    folders = [('', root)]
+    while folders:
+        reldir, folder = folders.pop()
+        try:
+            entries = _list_folder(folder)
+        except OSError:
+            continue
+        subfolders = []
+        prefix = reldir + os.sep if reldir else ''
+        for name, is_folder, is_link, entry in entries:
+            relpath = prefix + name
+            path = entry.path if entry is not None else os.path.join(folder,
+                                                                     name)
+            if not is_folder:
+                yield FileEntry(relpath, path, entry)
+            elif is_link:
+                continue
+            elif exclude is None or not exclude.matches_folder(relpath):
+                subfolders.append((relpath, path))
+        folders.extend(reversed(subfolders))
+
+
+def walk_folder(root='.', exclude=None):
+    # exclude is a GlobPattern, folders whose contents it excludes entirely
+    # aren't walked into
+    for entry in scan_folder(root, exclude):
+        yield entry.name
+
+
+def stat_signature(result):
+    # The signature of a file from its stat result
+    return result.st_mtime, result.st_size
+
+
+def file_signature(path):
+    # The mtime and size of a file, used to tell whether it changed
+    return stat_signature(os.stat(path))
+
+
+def replace_file(src, dst):
+    # Renames src to dst, replacing dst if it exists
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        # windows won't rename over an existing file
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def make_dirs(path, mode=0o755):
+    # Like os.makedirs, but doesn't fail if another thread or process 
+    # created the folder first
+    try:
+        os.makedirs(path, mode)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
 
 
 def open_file(path, mode='rb', create_dir=False, create_mode=0o755):
@@ -35,7 +147,7 @@ def open_file(path, mode='rb', create_dir=False, create_mode=0o755):
     if not newfile:
         # may raise OSError
         filedir = os.path.split(path)[0]
-        os.makedirs(filedir, create_mode)
+        make_dirs(filedir, create_mode)
         newfile = open(path, mode)
 
     return newfile
@@ -49,33 +161,310 @@ def copy_file(src, dst, create_dir=True, create_mode=0o755):
             raise
         # may raise OSError
         filedir = os.path.split(dst)[0]
-        os.makedirs(filedir, create_mode)
+        make_dirs(filedir, create_mode)
         shutil.copy2(src, dst)
 
 
-def matches_pattern(pattern, filepath):
-
-    def _is_match(pattern_list, token_list):
-        if not pattern_list or not token_list:
-            return False
-        i, j = 0, 0
-        while True:
-            if pattern_list[j] == '**':
-                if j+1 == len(pattern_list): return True
-                if _is_match(pattern_list[j+1:], token_list[i:]):
+def _same_content(src, dst, blocksize=1 << 16):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'rb') as fdst:
+            while True:
+                block = fsrc.read(blocksize)
+                if block != fdst.read(blocksize):
+                    return False
+                if not block:
                     return True
-                else:
-                    i+=1 
-            elif fnmatch.fnmatch(token_list[i], pattern_list[j]):
-                i+=1
-                j+=1
-            else:
-                return False
-            if i==len(token_list) and j==len(pattern_list):
-                return True
-            if i==len(token_list) or j==len(pattern_list):
-                return False
 
-    return _is_match(pattern.strip('/').split('/'), 
-                     filepath.strip('/').split('/'))
 
+def _copy_data(src, dst):
+    # Copies the contents of src to dst. Where os.copy_file_range exists the 
+    # kernel copies the data without reading it into python, and can share
+    # the blocks instead on filesystems that support reflinks.
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is not None:
+        try:
+            with open(src, 'rb') as fsrc:
+                with open(dst, 'wb') as fdst:
+                    remaining = os.fstat(fsrc.fileno()).st_size
+                    while remaining > 0:
+                        sent = copy_range(fsrc.fileno(), fdst.fileno(), 
+                                          remaining)
+                        if not sent:
+                            break
+                        remaining -= sent
+            return
+        except OSError:
+            pass
+    # shutil uses sendfile where it can
+    shutil.copyfile(src, dst)
+
+
+def _copy_stat(srcstat, dst):
+    # like shutil.copystat, with the stat of src at hand
+    os.chmod(dst, stat.S_IMODE(srcstat.st_mode))
+    if hasattr(srcstat, 'st_mtime_ns'):
+        os.utime(dst, ns=(srcstat.st_atime_ns, srcstat.st_mtime_ns))
+    else:
+        os.utime(dst, (srcstat.st_atime, srcstat.st_mtime))
+
+
+def sync_file(src, dst, checksum=False, link=False, create_dir=True,
+              create_mode=0o755, srcstat=None):
+    ''' Copies src to dst unless dst is already the same file.
+
+    dst is left alone if it has the same size and modification time as src, 
+    or if checksum is true, the same size and contents. With link, dst is
+    made a hard link to src where the filesystem allows it. Returns the 
+    number of bytes copied and the number of bytes that didn't need copying.
+    srcstat is the stat result of src, if the caller already has it.
+    '''
+    if srcstat is None:
+        srcstat = os.stat(src)
+    size = srcstat.st_size
+    try:
+        dststat = os.stat(dst)
+    except OSError:
+        dststat = None
+        if create_dir:
+            make_dirs(os.path.dirname(dst) or '.', create_mode)
+
+    if dststat is not None:
+        if os.path.samestat(srcstat, dststat):
+            return 0, size
+        if dststat.st_size == size:
+            if checksum:
+                if _same_content(src, dst):
+                    return 0, size
+            elif dststat.st_mtime == srcstat.st_mtime:
+                return 0, size
+        if link or dststat.st_nlink > 1:
+            # writing into a hard link would change the other links too
+            os.remove(dst)
+
+    if link:
+        try:
+            os.link(src, dst)
+            return 0, size
+        except (OSError, AttributeError):
+            pass
+
+    _copy_data(src, dst)
+    _copy_stat(srcstat, dst)
+    return size, 0
+
+
+# Text is worth compressing, both by the server and by the post-processing
+# stage of a build, when it's at least MIN_COMPRESS bytes
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json',
+                'application/xml', 'application/x-javascript', 
+                'image/svg+xml')
+MIN_COMPRESS = 256
+
+
+def compressible(ctype):
+    # whether content of the mime type ctype is worth compressing
+    return ctype.startswith(COMPRESSIBLE)
+
+
+def gzip_bytes(content):
+    # gzips content without a timestamp, so the result only depends on it
+    import gzip
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as zipped:
+        zipped.write(content)
+    return buf.getvalue()
+
+
+def hash_file(path, blocksize=1 << 16):
+    # the sha1 hex digest of a file's contents
+    digest = hashlib.sha1()
+    with open(path, 'rb') as afile:
+        for block in iter(lambda: afile.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    if unit == 'bytes':
+        return "{0} bytes".format(size)
+    return "{0:.1f} {1}".format(size, unit)
+
+
+class LRUCache(object):
+    ''' A mapping that holds at most maxsize items. 
+
+    When full, adding an item evicts the least recently used one. Counts the
+    hits and misses of get, which is safe to call from several threads.
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __repr__(self):
+        return "<LRUCache {0}/{1} items, {2} hits, {3} misses>".format(
+            len(self._items), self.maxsize, self.hits, self.misses)
+
+
+if sys.version > '3':
+    _string_types = (str,)
+else:
+    _string_types = (basestring,)
+
+# fnmatch ignores case where the filesystem does
+_PATTERN_FLAGS = re.DOTALL
+if os.path.normcase('A') == os.path.normcase('a'):
+    _PATTERN_FLAGS |= re.IGNORECASE
+
+
+def _translate_segment(segment):
+    # Like fnmatch.translate, for one path segment of a glob
+    i, n = 0, len(segment)
+    regex = ''
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = i
+            if j < n and segment[j] == '!':
+                j += 1
+            if j < n and segment[j] == ']':
+                j += 1
+            while j < n and segment[j] != ']':
+                j += 1
+            if j >= n:
+                regex += '\\['
+                continue
+            # escape what newer versions of re treat as set operations
+            chars = re.sub(r'([\\&~|[])', r'\\\1', segment[i:j])
+            i = j + 1
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            elif chars[0] == '^':
+                chars = '\\' + chars
+            regex += '(?!/)[' + chars + ']'
+        else:
+            regex += re.escape(c)
+    return regex
+
+
+def _translate_glob(segments):
+    # ** matches any number of folders, or at the end of a pattern, one or
+    # more path segments
+    regex = ''
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            regex += '.*' if last else '(?:[^/]*/)*'
+        else:
+            regex += _translate_segment(segment) + ('' if last else '/')
+    return regex
+
+
+def _compile_globs(globs):
+    # globs is a list of patterns split into path segments
+    if not globs:
+        return re.compile('(?!)')
+    regex = '|'.join(_translate_glob(segments) for segments in globs)
+    return re.compile('(?:' + regex + ')\\Z', _PATTERN_FLAGS)
+
+
+class GlobPattern(object):
+    ''' One or more file patterns compiled into a single regex.
+
+    Patterns can use fnmatch wildcards within a path segment, and ** to match
+    any number of folders. A path matches if it matches any of the patterns.
+    '''
+
+    def __init__(self, patterns):
+        if isinstance(patterns, _string_types):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        globs = [pattern.strip('/').split('/') for pattern in self.patterns]
+        self._regex = _compile_globs(globs)
+
+        # a folder matching the part of a pattern before a trailing ** has 
+        # all of its contents matched by that pattern
+        folders = []
+        for segments in globs:
+            if segments == ['**']:
+                folders.append(segments)
+            elif len(segments) > 1 and segments[-1] == '**':
+                folders.append(segments[:-1])
+        self._folder_regex = _compile_globs(folders)
+
+    def matches(self, filepath):
+        if os.sep != '/':
+            filepath = filepath.replace(os.sep, '/')
+        return self._regex.match(filepath.strip('/')) is not None
+
+    def matches_folder(self, folder):
+        ''' Whether every path inside folder matches. '''
+        if os.sep != '/':
+            folder = folder.replace(os.sep, '/')
+        return self._folder_regex.match(folder.strip('/')) is not None
+
+    def __repr__(self):
+        return "<GlobPattern {0!r}>".format(self.patterns)
+
+
+_glob_patterns = LRUCache(64)
+
+def compile_pattern(patterns):
+    ''' Returns a GlobPattern for a pattern or list of patterns. '''
+    key = patterns if isinstance(patterns, _string_types) else tuple(patterns)
+    compiled = _glob_patterns.get(key)
+    if compiled is None:
+        compiled = _glob_patterns[key] = GlobPattern(patterns)
+    return compiled
+
+
+def escape_pattern(path):
+    # a pattern that only matches path itself
+    return re.sub(r'([*?[])', r'[\1]', path)
+
+
+def matches_pattern(pattern, filepath):
+    return compile_pattern(pattern).matches(filepath)
@@ -0,0 +1,62 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+if sys.version > '3':
+    from io import StringIO
+else:
+    from StringIO import StringIO
+
+from tags import generator
+from tags.utils import open_file
+
+
+@contextmanager
+def quiet():
+    # captures what's printed meanwhile in the StringIO it yields
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = stdout
+
+
+class SiteTestCase(unittest.TestCase):
+    ''' A test with a temporary source folder, root, which is built into the
+    dest folder inside it. '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.dest = os.path.join(self.root, '_site')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+    def write(self, filename, content, folder=None):
+        # bytes are written as they are
+        mode = 'wb' if isinstance(content, bytes) else 'w'
+        path = os.path.join(folder or self.root, filename)
+        with open_file(path, mode, create_dir=True) as afile:
+            afile.write(content)
+
+
+    def read(self, filename, folder=None):
+        with open(os.path.join(folder or self.dest, filename), 'rb') as afile:
+            return afile.read().decode('utf-8')
+
+
+    def exists(self, filename):
+        return os.path.exists(os.path.join(self.dest, filename))
+
+
+    def build(self, **kwargs):
+        # builds root into dest, and returns what the build printed
+        with quiet() as output:
+            generator.build_files(root=self.root, dest=self.dest, **kwargs)
+        return output.getvalue()
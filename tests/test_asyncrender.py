@@ -0,0 +1,94 @@
+import unittest
+import asyncio
+import time
+
+from tags.profiling import Profiler
+from tags.templatelang import TemplateLanguage, TemplateText
+from tags.templatelang import TagErrorException
+
+
+class TestParseAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.running = 0
+        self.most = 0
+
+        async def _fetch(arg, context={}):
+            self.running += 1
+            self.most = max(self.most, self.running)
+            await asyncio.sleep(0.02)
+            self.running -= 1
+            return arg.upper()
+
+        def _echo(arg, context={}):
+            return arg
+
+        def _wrap(arg, body='', context={}):
+            return "<{0}>{1}</{0}>".format(arg, body)
+
+        async def _partial(arg, context={}):
+            await asyncio.sleep(0)
+            return TemplateText("[{% fetch " + arg + " %}{% echo ! %}]")
+
+        async def _fail(context={}):
+            raise ValueError("oops")
+
+        self.tags = {'fetch': _fetch, 'echo': _echo, 'wrap': _wrap,
+                     'partial': _partial, 'fail': _fail}
+        self.lang = TemplateLanguage(tags=self.tags, reparse=False,
+                                     engine='scanner', concurrency=5)
+
+
+    def parse_async(self, string, **context):
+        return asyncio.run(self.lang.parse_async(string, **context))
+
+
+    def test_same_as_sync(self):
+        teststr = ("a {% fetch b %} {% echo c %} "
+                   "{% wrap p %}{% fetch d %}{% partial e %}{% endwrap %}"
+                   "{% partial f %}")
+        result = self.parse_async(teststr)
+        self.assertEqual(result, "a B c <p>D[E!]</p>[F!]")
+        self.assertEqual(self.lang.parse(teststr), result)
+
+
+    def test_concurrency(self):
+        teststr = "".join("{% fetch " + str(i) + " %}" for i in range(30))
+        start = time.time()
+        result = self.parse_async(teststr)
+        elapsed = time.time() - start
+        self.assertEqual(result, "".join(str(i) for i in range(30)))
+        self.assertEqual(self.most, 5)
+        self.assertTrue(elapsed < 30 * 0.02 / 2)
+
+
+    def test_errors(self):
+        teststr = "{% fetch a %}\n{% fail %}{% echo %}"
+        with self.assertRaises(TagErrorException) as cm:
+            self.parse_async(teststr)
+        with self.assertRaises(TagErrorException) as sync:
+            self.lang.parse(teststr)
+        self.assertEqual(cm.exception.msg, "oops")
+        self.assertEqual((cm.exception.msg, cm.exception.loc),
+                         (sync.exception.msg, sync.exception.loc))
+
+
+    def test_cycle(self):
+        def _loop(arg, context={}):
+            return TemplateText("{% fetch x %}{% loop " + arg + " %}")
+
+        self.lang.add_tag_with_name('loop')(_loop)
+        with self.assertRaises(TagErrorException) as cm:
+            self.parse_async("{% loop a %}")
+        self.assertEqual(cm.exception.msg, "tag 'loop a' expands to itself")
+
+
+    def test_profile(self):
+        self.lang.profiler = Profiler()
+        self.parse_async("{% fetch a %}{% fetch b %}{% echo c %}")
+        self.assertEqual(self.lang.profiler.tags['fetch'][0], 2)
+        self.assertEqual(self.lang.profiler.tags['echo'][0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,16 @@
 import unittest
 import os
+import sys
 import shutil
+import tarfile
+import zipfile
+import tempfile
+import subprocess
 from filecmp import dircmp
  
 from tags.utils import *
 from tags import generator
+from tests.helpers import SiteTestCase, quiet
 
 
 class TestTemplateLanguage(unittest.TestCase):
@@ -15,10 +21,13 @@ class TestTemplateLanguage(unittest.TestCase):
         cls.cwd = os.getcwd()
         os.chdir(wwwroot)
         shutil.rmtree(os.path.join(wwwroot, "_site"), ignore_errors=True)
+        shutil.rmtree(os.path.join(wwwroot, generator.STATE_DIR), 
+                      ignore_errors=True)
 
 
     @classmethod
     def tearDownClass(cls):
+        shutil.rmtree(generator.STATE_DIR, ignore_errors=True)
         os.chdir(cls.cwd)
 
 
@@ -32,5 +41,298 @@ class TestTemplateLanguage(unittest.TestCase):
         self.assertEqual(dircmp('_gen_result_2', '_site').diff_files, [])
 
 
+    def test_build_files_parallel(self):
+        dest = tempfile.mkdtemp()
+        try:
+            generator.build_files(dest=dest, jobs=2)
+            result = dircmp('_gen_result_2', dest)
+            self.assertEqual(result.diff_files, [])
+            self.assertEqual(result.left_only, [])
+        finally:
+            shutil.rmtree(dest)
+
+
+    def test_parallel_errors(self):
+        root = tempfile.mkdtemp()
+        try:
+            for i in range(4):
+                with open(os.path.join(root, '{0}.html'.format(i)), 'w') as f:
+                    f.write("ok\n{% include %}")
+            outputs = []
+            for jobs in (1, 2):
+                with quiet() as output:
+                    generator.build_files(root=root, 
+                                          dest=os.path.join(root, '_site'),
+                                          force=True, jobs=jobs)
+                outputs.append(output.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(outputs[0].count("Parse Error"), 4)
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_build_archive(self):
+        dest = tempfile.mkdtemp()
+        # the source is touched, so it's a copy of the site
+        root = os.path.join(dest, 'www')
+        shutil.copytree('.', root, 
+                        ignore=shutil.ignore_patterns('_*', '.tags-state'))
+        try:
+            for name, jobs in (('site.tar.gz', 1), ('site.zip', 2)):
+                path = os.path.join(dest, name)
+                generator.build_files(root=root, dest=path, jobs=jobs)
+                with open(path, 'rb') as afile:
+                    content = afile.read()
+                os.utime(os.path.join(root, 'index.html'), None)
+                generator.build_files(root=root, dest=path, jobs=jobs)
+                with open(path, 'rb') as afile:
+                    self.assertEqual(afile.read(), content)
+
+            with tarfile.open(os.path.join(dest, 'site.tar.gz')) as archive:
+                names = archive.getnames()
+                self.assertEqual(names, sorted(names))
+                index = archive.extractfile('index.html').read()
+            with zipfile.ZipFile(os.path.join(dest, 'site.zip')) as archive:
+                self.assertEqual(archive.namelist(), names)
+                self.assertEqual(archive.read('index.html'), index)
+            with open('_gen_result_2/index.html', 'rb') as afile:
+                self.assertEqual(index, afile.read())
+            self.assertEqual(sorted(os.listdir(dest)), 
+                             ['site.tar.gz', 'site.zip', 'www'])
+        finally:
+            shutil.rmtree(dest)
+
+
+    def test_shards(self):
+        dest = tempfile.mkdtemp()
+        try:
+            for shard_by in generator.SHARD_BY:
+                shards = [os.path.join(dest, shard_by + str(index)) 
+                          for index in (1, 2, 3)]
+                with quiet():
+                    for index, shard in enumerate(shards):
+                        generator.build_files(dest=shard, 
+                                              shard=(index + 1, 3),
+                                              shard_by=shard_by)
+                built = [[name for name in walk_folder(shard) 
+                          if name != generator.MANIFEST] for shard in shards]
+                self.assertEqual(sum(len(names) for names in built), 
+                                 len(set(sum(built, []))))
+
+                merged = os.path.join(dest, shard_by)
+                with quiet():
+                    generator.merge_shards(shards, dest=merged)
+                    self.assertRaises(SystemExit, generator.merge_shards, 
+                                      shards[:2], dest=merged)
+                    self.assertRaises(SystemExit, generator.merge_shards,
+                                      shards[:2] + [shards[0]], dest=merged)
+                result = dircmp('_gen_result_2', merged)
+                self.assertEqual(result.diff_files, [])
+                self.assertEqual(result.left_only, [])
+
+            # a shard can't be an archive
+            archive = os.path.join(dest, 'shard.tar')
+            with quiet():
+                self.assertRaises(SystemExit, generator.build_files, 
+                                  dest=archive, shard=(1, 3))
+            self.assertFalse(os.path.exists(archive))
+        finally:
+            shutil.rmtree(dest)
+
+
+class TestIncrementalBuild(SiteTestCase):
+
+    def setUp(self):
+        SiteTestCase.setUp(self)
+        self.write('index.html', "{% include _partials/header.html %}index")
+        self.write('about.html', "about")
+        self.write('_partials/header.html', "{% include _partials/nav.html %}")
+        self.write('_partials/nav.html', "nav ")
+        self.write('css/style.css', "style")
+        self.build()
+
+
+    def test_unchanged(self):
+        for filename in ('index.html', 'about.html', 'css/style.css'):
+            self.write(filename, "stale", self.dest)
+        self.build()
+        for filename in ('index.html', 'about.html', 'css/style.css'):
+            self.assertEqual(self.read(filename), "stale")
+
+
+    def test_changed_partial(self):
+        self.write('index.html', "stale", self.dest)
+        self.write('about.html', "stale", self.dest)
+        self.write('_partials/nav.html', "new nav ")
+        self.build()
+        self.assertEqual(self.read('index.html'), "new nav index")
+        self.assertEqual(self.read('about.html'), "stale")
+
+
+    def test_changed_source(self):
+        self.write('css/style.css', "new style")
+        self.build()
+        self.assertEqual(self.read('css/style.css'), "new style")
+
+
+    def test_deleted_source(self):
+        os.remove(os.path.join(self.root, 'css/style.css'))
+        self.build()
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'css')))
+        self.assertEqual(self.read('index.html'), "nav index")
+
+
+    def test_failed_build(self):
+        self.write('index.html', "{% include _partials/missing.html %}")
+        self.build()
+        self.assertEqual(self.read('index.html'), "nav index")
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ['about.html', 'css', 'index.html'])
+
+
+    def test_manifest_outside(self):
+        state = generator._state_dir(self.root, self.dest)
+        self.assertTrue(os.path.exists(
+            os.path.join(state, generator.MANIFEST)))
+        # a manifest left in dest by an older version is moved out of it
+        os.rename(os.path.join(state, generator.MANIFEST),
+                  os.path.join(self.dest, generator.MANIFEST))
+        self.write('index.html', "stale", self.dest)
+        self.build()
+        self.assertEqual(self.read('index.html'), "stale")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dest, generator.MANIFEST)))
+
+
+    def test_state_not_published(self):
+        # the manifests of a build aren't part of the source of another one
+        self.build(compress=True)
+        self.dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dest)
+        self.build()
+        self.assertEqual(sorted(os.listdir(self.dest)),
+                         ['about.html', 'css', 'index.html'])
+        self.assertTrue(os.path.exists(os.path.join(
+            generator._state_dir(self.root, self.dest), generator.MANIFEST)))
+
+        self.dest = os.path.join(self.root, 'site.tar')
+        self.build()
+        with tarfile.open(self.dest) as archive:
+            self.assertEqual(sorted(archive.getnames()), 
+                             ['about.html', 'css/style.css', 'index.html'])
+        site = generator.MemorySite(root=self.root)
+        self.assertTrue(site.excludes(generator.STATE_DIR + '/x'))
+
+
+    def test_changed_after_failure(self):
+        # a page that failed is built again when the partial is fixed, or
+        # when a missing partial is created
+        self.write('_partials/nav.html', "{% include %}")
+        self.build(changed=['_partials/nav.html'])
+        self.assertEqual(self.read('index.html'), "nav index")
+        self.write('_partials/nav.html', "fixed nav ")
+        self.build(changed=['_partials/nav.html'])
+        self.assertEqual(self.read('index.html'), "fixed nav index")
+
+        self.write('about.html', "{% include _partials/missing.html %}")
+        self.build(changed=['about.html'])
+        self.assertEqual(self.read('about.html'), "about")
+        self.write('_partials/missing.html', "found")
+        self.build(changed=['_partials/missing.html'])
+        self.assertEqual(self.read('about.html'), "found")
+
+
+    def test_changed_paths(self):
+        self.write('index.html', "stale", self.dest)
+        self.write('about.html', "stale", self.dest)
+        self.write('_partials/nav.html', "new nav ")
+        self.write('about.html', "new about")
+        os.remove(os.path.join(self.root, 'css/style.css'))
+        self.build(changed=['_partials/nav.html'])
+        self.assertEqual(self.read('index.html'), "new nav index")
+        self.assertEqual(self.read('about.html'), "stale")
+        self.build(changed=['css/style.css', 'new.html'])
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'css')))
+        self.assertEqual(self.read('about.html'), "stale")
+
+
+    def test_passthrough(self):
+        # pages without tags are copied as they are, even if they're not utf-8
+        self.write('latin1.html', b"caf\xe9")
+        self.build()
+        with open(os.path.join(self.dest, 'latin1.html'), 'rb') as afile:
+            self.assertEqual(afile.read(), b"caf\xe9")
+        self.assertEqual(
+            os.stat(os.path.join(self.root, 'about.html')).st_mtime,
+            os.stat(os.path.join(self.dest, 'about.html')).st_mtime)
+        self.assertNotEqual(
+            os.stat(os.path.join(self.root, 'about.html')).st_ino,
+            os.stat(os.path.join(self.dest, 'about.html')).st_ino)
+
+        # and fingerprinting doesn't need them to be either
+        self.write('latin1.html', b"<img src='caf\xe9.png'>"
+                   b"<link href=\"css/style.css\">caf\xe9")
+        self.build(fingerprint=True)
+        with open(os.path.join(self.dest, 'latin1.html'), 'rb') as afile:
+            content = afile.read()
+        self.assertTrue(content.startswith(b"<img src='caf\xe9.png'>"))
+        self.assertTrue(content.endswith(b"\">caf\xe9"))
+        self.assertFalse(b"css/style.css" in content)
+
+        site = generator.MemorySite(root=self.root)
+        self.assertEqual(site.render('latin1.html')[1], 
+                         b"<img src='caf\xe9.png'><link href=\"css/style.css\">"
+                         b"caf\xe9")
+        self.assertEqual(site.render('index.html')[1], b"nav index")
+
+
+    def test_watched_changes(self):
+        changes = generator._Changes(self.root, self.dest)
+        changes.add(os.path.join(self.dest, 'index.html'))
+        changes.add(os.path.join(os.path.dirname(self.root), 'other.html'))
+        self.assertEqual(changes.take(0), None)
+        changes.add(os.path.join(self.root, 'about.html'))
+        changes.add(os.path.join(self.root, '_partials/nav.html'))
+        changes.add(os.path.join(self.root, 'about.html'))
+        self.assertEqual(changes.take(60), None)
+        self.assertEqual(changes.take(0),
+                         (['_partials/nav.html', 'about.html'], False))
+        self.assertEqual(changes.take(0), None)
+
+
+class TestStartup(SiteTestCase):
+
+    def test_lazy_imports(self):
+        # building a site doesn't need the server, the pyparsing engine or a
+        # process pool, so they shouldn't slow down the startup of a build
+        self.write('index.html', "{% is index.html %}index{% endis %}")
+        script = ("import sys\n"
+                  "from tags import generator\n"
+                  "generator.build_files(root=sys.argv[1], "
+                  "dest=sys.argv[1] + '/_site')\n"
+                  "print(' '.join(sorted(sys.modules)))\n")
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.realpath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', script,
+                                          self.root], env=env)
+        modules = output.decode('utf-8').splitlines()[-1].split()
+        for module in ('pyparsing', 'multiprocessing', 'tags.server',
+                       'tags.postprocess'):
+            self.assertFalse(module in modules, module)
+        self.assertEqual(self.read('index.html'), "index")
+
+
+    def test_archive_to_stdout(self):
+        # stdout is the archive, so messages go to stderr
+        with quiet() as output:
+            self.assertRaises(SystemExit, generator.build_files,
+                              root=self.root, dest='-')
+            self.write('index.html', "index")
+            self.assertRaises(SystemExit, generator.build_files,
+                              root=self.root, dest='-', watch=True)
+        self.assertEqual(output.getvalue(), "")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,79 @@
+import unittest
+import os
+import gzip
+import json
+
+from tags import generator
+from tags import postprocess
+from tests.helpers import SiteTestCase
+
+
+STYLE = "body { color: red; }\n" * 20
+
+
+class TestPostprocess(SiteTestCase):
+
+    def setUp(self):
+        SiteTestCase.setUp(self)
+        self.write('index.html', '<link href="css/style.css?v=1"><img '
+                   'src="/img/logo.png"><a href="http://x.com/a.css">' + 
+                   ' ' * 300)
+        self.write('sub/page.html', "<link href='../css/style.css'>")
+        self.write('css/style.css', STYLE)
+        self.write('img/logo.png', "png")
+
+
+    def assets(self):
+        with open(os.path.join(generator._state_dir(self.root, self.dest), 
+                               postprocess.MANIFEST)) as afile:
+            return json.load(afile)['assets']
+
+
+    def test_compress(self):
+        self.build(compress=True)
+        with gzip.open(os.path.join(self.dest, 'css/style.css.gz')) as afile:
+            self.assertEqual(afile.read().decode('utf-8'), STYLE)
+        self.assertTrue(self.exists('index.html.gz'))
+        self.assertFalse(self.exists('sub/page.html.gz'))
+        self.assertFalse(self.exists('img/logo.png.gz'))
+
+        mtime = os.path.getmtime(os.path.join(self.dest, 'css/style.css.gz'))
+        self.build(compress=True, incremental=False)
+        self.assertEqual(
+            os.path.getmtime(os.path.join(self.dest, 'css/style.css.gz')),
+            mtime)
+
+        self.build()
+        self.assertFalse(self.exists('css/style.css.gz'))
+        self.assertFalse(self.exists('index.html.gz'))
+
+
+    def test_fingerprint(self):
+        self.build(fingerprint=True)
+        style = self.assets()['css/style.css']
+        logo = self.assets()['img/logo.png']
+        self.assertTrue(self.exists(style) and self.exists(logo))
+        self.assertEqual(self.read('index.html').split('<a')[0],
+                         '<link href="{0}?v=1"><img src="/{1}">'.format(
+                             style, logo))
+        self.assertTrue('http://x.com/a.css' in self.read('index.html'))
+        self.assertEqual(self.read('sub/page.html'),
+                         "<link href='../{0}'>".format(style))
+
+        # pages that aren't rebuilt still get the new copies
+        self.write('css/style.css', STYLE + "p {}\n")
+        self.build(fingerprint=True)
+        newstyle = self.assets()['css/style.css']
+        self.assertNotEqual(newstyle, style)
+        self.assertFalse(self.exists(style))
+        self.assertEqual(self.read('sub/page.html'),
+                         "<link href='../{0}'>".format(newstyle))
+
+        self.build()
+        self.assertFalse(self.exists(newstyle))
+        self.assertEqual(self.read('sub/page.html'),
+                         "<link href='../css/style.css'>")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import json
+import time
+
+from tags.profiling import Profiler
+from tags.templatelang import TemplateLanguage
+from tests.helpers import SiteTestCase
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_tag_times(self):
+        def _sleep(arg, context={}):
+            time.sleep(0.01)
+            return arg
+
+        def _outer(arg, context):
+            return lang.expand(lang.compile(arg + " {% sleep x %}"), context)
+
+        profiler = Profiler()
+        lang = TemplateLanguage(tags={'sleep': _sleep, 'outer': _outer})
+        lang.profiler = profiler
+        self.assertEqual(lang.parse("{% outer a %}"), "a x")
+
+        calls, cumulative, own = profiler.tags['outer']
+        self.assertEqual(calls, 1)
+        self.assertTrue(cumulative >= 0.01)
+        self.assertTrue(own < profiler.tags['sleep'][1])
+        self.assertEqual(profiler.tags['sleep'][0], 1)
+
+        lang.profiler = None
+        self.assertEqual(lang.parse("{% outer a %}"), "a x")
+        self.assertEqual(profiler.tags['outer'][0], 1)
+
+
+    def test_merge(self):
+        profiler = Profiler()
+        profiler.add('index.html', 'render', 1.0)
+        with profiler.step('build'):
+            pass
+        other = Profiler()
+        other.add('index.html', 'render', 2.0)
+        other.add('about.html', 'read', 0.5)
+        with other.tag('include'):
+            pass
+        profiler.merge(json.loads(json.dumps(other.as_dict())))
+
+        data = profiler.as_dict()
+        self.assertEqual(data['files'], {'index.html': {'render': 3.0},
+                                         'about.html': {'read': 0.5}})
+        self.assertEqual(data['tags']['include']['calls'], 1)
+        self.assertEqual(list(data['steps']), ['build'])
+
+        report = profiler.report(top=1)
+        self.assertTrue("Slowest 1 files:" in report)
+        self.assertTrue("index.html" in report)
+        self.assertFalse("about.html" in report)
+        self.assertTrue("include" in report)
+
+
+class TestProfiledBuild(SiteTestCase):
+
+    def test_build_files(self):
+        self.write('index.html', "{% include _partials/nav.html %}index")
+        self.write('_partials/nav.html', "nav ")
+        self.write('css/style.css', "style")
+
+        for jobs in (1, 2):
+            profiler = Profiler()
+            self.build(jobs=jobs, incremental=False, profiler=profiler)
+            self.assertEqual(sorted(profiler.files['index.html']),
+                             ['compile', 'read', 'render', 'write'])
+            self.assertEqual(list(profiler.files['css/style.css']), ['copy'])
+            self.assertEqual(profiler.tags['include'][0], 1)
+            self.assertTrue(set(['scan', 'build']) <= set(profiler.steps))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import unittest
+import io
+import os
+import gzip
+import sys
+import shutil
+import socket
+import tempfile
+
+if sys.version > '3':
+    from http.client import HTTPConnection
+else:
+    from httplib import HTTPConnection
+
+from tags import server
+from tags import tags
+from tags.generator import MemorySite
+from tags.utils import open_file
+
+
+class TestServer(unittest.TestCase):
+
+    index = b"index"
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('index.html', "index")
+        self.write('css/style.css', "style")
+        self.write('js/app.js', "var x = 1;\n" * 100)
+        self.httpd = server.start_server(root=self.root, port=0, workers=2)
+        self.port = self.httpd.server_address[1]
+
+
+    def tearDown(self):
+        server.stop_server(self.httpd)
+        shutil.rmtree(self.root)
+
+
+    def write(self, filename, content):
+        path = os.path.join(self.root, filename)
+        with open_file(path, 'w', create_dir=True) as afile:
+            afile.write(content)
+
+
+    def get(self, conn, path, headers={}):
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+
+    def response(self, path, headers={}):
+        conn = HTTPConnection('localhost', self.port, timeout=5)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            return response, response.read()
+        finally:
+            conn.close()
+
+
+    def test_keep_alive(self):
+        conn = HTTPConnection('localhost', self.port, timeout=5)
+        self.assertEqual(self.get(conn, '/'), (200, self.index))
+        sock = conn.sock
+        self.assertEqual(self.get(conn, '/css/style.css'), (200, b"style"))
+        self.assertEqual(self.get(conn, '/../css/../index.html'), 
+                         (200, self.index))
+        self.assertTrue(conn.sock is sock)
+        self.assertEqual(self.get(conn, '/missing.html')[0], 404)
+        conn.close()
+
+
+    def test_slow_client(self):
+        # a client that connects and never sends its request doesn't hold up
+        # the others
+        slow = socket.create_connection(('localhost', self.port))
+        try:
+            conn = HTTPConnection('localhost', self.port, timeout=5)
+            self.assertEqual(self.get(conn, '/'), (200, self.index))
+            conn.close()
+        finally:
+            slow.close()
+
+
+    def test_etag(self):
+        response, body = self.response('/')
+        etag = response.getheader('ETag')
+        self.assertEqual(response.getheader('Cache-Control'), 'no-cache')
+        response, body = self.response('/', {'If-None-Match': etag})
+        self.assertEqual((response.status, body), (304, b""))
+        response, body = self.response('/', {'If-None-Match': '"other"'})
+        self.assertEqual((response.status, body), (200, self.index))
+        self.write('index.html', "changed index")
+        response, body = self.response('/', {'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+
+
+    def test_if_modified_since(self):
+        response, body = self.response('/css/style.css')
+        modified = response.getheader('Last-Modified')
+        response, body = self.response('/css/style.css', 
+                                       {'If-Modified-Since': modified})
+        self.assertEqual(response.status, 304)
+        response, body = self.response('/css/style.css', 
+            {'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual((response.status, body), (200, b"style"))
+
+
+    def test_gzip(self):
+        expected = b"var x = 1;\n" * 100
+        response, body = self.response('/js/app.js', 
+                                       {'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(body)).read(), 
+                         expected)
+        etag = response.getheader('ETag')
+        response, body = self.response('/js/app.js', 
+                                       {'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual((response.status, body), (200, expected))
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        response, body = self.response('/js/app.js', {'If-None-Match': etag,
+                                                      'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status, 304)
+
+        self.write('js/app.js.gz', "precompressed")
+        response, body = self.response('/js/app.js', 
+                                       {'Accept-Encoding': 'gzip'})
+        self.assertEqual(body, b"precompressed")
+
+
+    def test_range(self):
+        expected = b"var x = 1;\n" * 100
+        response, body = self.response('/js/app.js', {'Range': 'bytes=4-8'})
+        self.assertEqual((response.status, body), (206, expected[4:9]))
+        self.assertEqual(response.getheader('Content-Range'), 
+                         'bytes 4-8/1100')
+        response, body = self.response('/js/app.js', {'Range': 'bytes=-3'})
+        self.assertEqual((response.status, body), (206, expected[-3:]))
+        response, body = self.response('/js/app.js', {'Range': 'bytes=1000-'})
+        self.assertEqual((response.status, body), (206, expected[1000:]))
+        response, body = self.response('/js/app.js', {'Range': 'bytes=2000-'})
+        self.assertEqual(response.status, 416)
+        response, body = self.response('/js/app.js', {'Range': 'bytes=0-1', 
+                                                      'If-Range': '"old"'})
+        self.assertEqual((response.status, body), (200, expected))
+
+
+class TestPreview(TestServer):
+
+    index = b"nav index"
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('index.html', "{% include _partials/nav.html %}index")
+        self.write('bad.html', "{% include %}")
+        self.write('_partials/nav.html', "nav ")
+        self.write('.tags-state/x/.tags-manifest', "{}")
+        self.write('css/style.css', "style")
+        self.write('js/app.js', "var x = 1;\n" * 100)
+        tags.source_cache.clear()
+        tags.output_cache.clear()
+        site = MemorySite(root=self.root)
+        self.httpd = server.start_server(root=self.root, port=0, workers=2,
+                                         handler=server.PreviewHandler,
+                                         site=site)
+        self.port = self.httpd.server_address[1]
+
+
+    def test_render(self):
+        conn = HTTPConnection('localhost', self.port, timeout=5)
+        self.assertEqual(self.get(conn, '/'), (200, b"nav index"))
+        self.assertEqual(self.get(conn, '/index.html'), (200, b"nav index"))
+        self.assertEqual(self.get(conn, '/css/style.css'), (200, b"style"))
+        self.write('_partials/nav.html', "new nav ")
+        self.assertEqual(self.get(conn, '/'), (200, b"new nav index"))
+        self.assertEqual(self.get(conn, '/bad.html')[0], 500)
+        conn.close()
+        conn = HTTPConnection('localhost', self.port, timeout=5)
+        self.assertEqual(self.get(conn, '/_partials/nav.html')[0], 404)
+        conn.close()
+        # excluded folders aren't listed
+        for path in ('/_partials/', '/_partials', '/.tags-state/'):
+            conn = HTTPConnection('localhost', self.port, timeout=5)
+            self.assertEqual(self.get(conn, path)[0], 404)
+            conn.close()
+        conn = HTTPConnection('localhost', self.port, timeout=5)
+        self.assertEqual(self.get(conn, '/css/')[0], 200)
+        conn.close()
+        self.assertEqual(sorted(os.listdir(self.root)), 
+                         ['.tags-state', '_partials', 'bad.html', 'css', 
+                          'index.html', 'js'])
+
+
+if __name__ == '__main__':
+    unittest.main()
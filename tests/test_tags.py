@@ -0,0 +1,101 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from tags import tags
+from tags.templatelang import TagErrorException
+
+
+class TestInclude(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('nav.html', "{% is a.html %}A{% endis %}nav")
+        self.write('outer.html', "<{% include inner.html %}>")
+        self.write('inner.html', "inner")
+        self.write('loop.html', "{% include loop.html %}")
+        tags.source_cache.clear()
+        tags.output_cache.clear()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+    def write(self, filename, content):
+        with open(os.path.join(self.root, filename), 'w') as afile:
+            afile.write(content)
+
+
+    def render(self, content, filename='a.html'):
+        return tags.render(content, filename=filename, rootdir=self.root)
+
+
+    def test_include(self):
+        self.assertEqual(self.render("{% include nav.html %}"), "Anav")
+        self.assertEqual(self.render("{% include nav.html %}", 'b.html'), "nav")
+        self.assertEqual(self.render("{% include outer.html %}"), "<inner>")
+
+
+    def test_output_cache(self):
+        for i in range(3):
+            self.assertEqual(self.render("{% include nav.html %}"), "Anav")
+            self.assertEqual(self.render("{% include nav.html %}", 'b.html'),
+                             "nav")
+        self.assertEqual(tags.source_cache.misses, 1)
+        self.assertEqual(tags.output_cache.hits, 4)
+
+
+    def test_output_cache_keys(self):
+        # an output is only used for contexts with the keys it depends on
+        def pick(context={}):
+            return str(context['b'] if context['a'] == 1 else context['c'])
+        tags.lang.add_tag_with_name('pick')(pick)
+
+        def _remove():
+            del tags.lang._tags['pick']
+            tags.lang._keywords = None
+            tags.lang._parser = None
+            tags.lang._templates.clear()
+        self.addCleanup(_remove)
+
+        self.write('pick.html', "{% pick %}")
+        outputs = [tags.lang.parse("{% include pick.html %}", 
+                                   rootdir=self.root, **context)
+                   for context in ({'a': 1, 'b': 5}, {'a': 2, 'c': 7}, 
+                                   {'a': 1, 'b': 9, 'c': 5})]
+        self.assertEqual(outputs, ["5", "7", "9"])
+
+
+    def test_changed_partials(self):
+        self.assertEqual(self.render("{% include outer.html %}"), "<inner>")
+        self.write('inner.html', "changed")
+        self.assertEqual(self.render("{% include outer.html %}"), "<changed>")
+        self.write('outer.html', "[[{% include inner.html %}]]")
+        self.assertEqual(self.render("{% include outer.html %}"), "[[changed]]")
+
+
+    def test_render_many(self):
+        content = "{% include outer.html %}|{% include nav.html %}"
+        filenames = ['a.html', 'b.html', 'c.html']
+        dependencies = set()
+        outputs = tags.render_many(content, filenames, rootdir=self.root,
+                                   dependencies=dependencies)
+        self.assertEqual(list(outputs), ["<inner>|Anav", "<inner>|nav",
+                                         "<inner>|nav"])
+        self.assertEqual(sorted(os.path.basename(path)
+                                for path in dependencies),
+                         ['inner.html', 'nav.html', 'outer.html'])
+        self.assertEqual(tags.source_cache.misses, 3)
+
+
+    def test_include_cycle(self):
+        with self.assertRaises(TagErrorException) as cm:
+            self.render("{% include loop.html %}")
+        self.assertEqual(cm.exception.msg,
+                         "tag 'include loop.html' expands to itself")
+
+
+if __name__ == '__main__':
+    unittest.main()
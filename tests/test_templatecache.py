@@ -0,0 +1,138 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from tags import generator
+from tags import tags
+from tags.templatelang import TemplateLanguage
+from tags.templatecache import TemplateCache
+from tags.utils import walk_folder
+from tests.helpers import SiteTestCase
+
+
+def _t(body='', context={}):
+    return body.upper()
+
+
+def _u(arg, context={}):
+    return arg
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+
+    def lang(self, **kwargs):
+        # a new language, whose parsing is counted
+        lang = TemplateLanguage(tags={'t': _t, 'u': _u}, reparse=False,
+                                **kwargs)
+        lang.cache = TemplateCache(self.folder)
+        lang.compiled = []
+        compile = lang._compile
+
+        def _compile(string):
+            lang.compiled.append(string)
+            return compile(string)
+        lang._compile = _compile
+        return lang
+
+
+    def test_shared(self):
+        source = "a {%t%}b {%u c%}{%endt%} e"
+        lang = self.lang()
+        self.assertEqual(lang.parse(source), "a B C e")
+        # the body of t is compiled too, to render it
+        self.assertEqual(lang.compiled, [source, "b {%u c%}"])
+
+        lang = self.lang()
+        template = lang.compile(source)
+        self.assertEqual(lang.cache.hits, 1)
+        self.assertEqual(lang.render(template), "a B C e")
+        self.assertEqual(lang.compiled, [])
+        self.assertEqual(repr(template), repr(self.lang().compile(source)))
+
+
+    def test_language(self):
+        source = "{%u a%}"
+        self.lang().compile(source)
+        lang = self.lang(openseq='{%', closeseq='%}')
+        lang.compile(source)
+        self.assertEqual(lang.compiled, [])
+
+        lang = self.lang()
+        lang.add_tag_with_name('v')(_u)
+        lang.compile(source)
+        self.assertEqual(lang.compiled, [source])
+
+
+    def test_damaged(self):
+        lang = self.lang()
+        lang.compile("{%u a%}")
+        for path in walk_folder(self.folder):
+            with open(os.path.join(self.folder, path), 'wb') as afile:
+                afile.write(b"\x00damaged")
+        lang = self.lang()
+        self.assertEqual(lang.render(lang.compile("{%u a%}")), "a")
+        self.assertEqual(lang.compiled, ["{%u a%}"])
+
+
+    def test_prune(self):
+        lang = self.lang()
+        for i in range(5):
+            lang.compile("{%u " + str(i) + "%}")
+        cache = TemplateCache(self.folder, max_files=3)
+        # the least recently used are removed
+        paths = sorted(walk_folder(self.folder))
+        for i, path in enumerate(paths):
+            os.utime(os.path.join(self.folder, path), (i, i))
+        self.assertEqual(cache.prune(), 2)
+        self.assertEqual(sorted(walk_folder(self.folder)), paths[2:])
+
+        cache = TemplateCache(self.folder, max_size=0)
+        self.assertEqual(cache.prune(), 3)
+        self.assertEqual(list(walk_folder(self.folder)), [])
+
+
+class TestCachedBuild(SiteTestCase):
+
+    def test_build(self):
+        for filename, content in generator.NEW_SITE.items():
+            self.write(filename, content)
+        cache_dir = os.path.join(self.root, '.tags-cache')
+        outputs = []
+        for i in range(2):
+            tags.lang._templates.clear()
+            self.build(incremental=False, cache_dir=cache_dir)
+            outputs.append(self.read('index.html'))
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue(tags.lang.cache is None)
+        self.assertTrue(list(walk_folder(cache_dir)))
+        self.assertFalse(self.exists('.tags-cache'))
+
+
+    def test_archive_workers(self):
+        # archive workers that aren't forked from the build use the cache too
+        self.write('index.html', "{% is index.html %}index{% endis %}")
+        self.write('about.html', "{% is about.html %}about{% endis %}")
+        cache_dir = os.path.join(self.root, '.tags-cache')
+        tags.lang._templates.clear()
+        try:
+            self.assertEqual(
+                generator._render_task('index.html', self.root, cache_dir),
+                (None, b"index", []))
+            self.assertEqual(tags.lang.cache.folder, cache_dir)
+        finally:
+            tags.lang.cache = None
+        self.assertTrue(list(walk_folder(cache_dir)))
+
+        self.dest = os.path.join(self.root, 'site.zip')
+        self.build(jobs=2, cache_dir=cache_dir)
+        self.assertTrue(os.path.exists(self.dest))
+        self.assertTrue(tags.lang.cache is None)
@@ -2,7 +2,10 @@ import unittest
 import os
 import sys
 
-from tags.templatelang import TemplateLanguage
+from pyparsing import ParserElement
+
+from tags.templatelang import TemplateLanguage, TemplateText
+from tags.templatelang import TagErrorException
 
 def _testfile(name):
     root = os.path.dirname(os.path.realpath(__file__))
@@ -10,6 +13,8 @@ def _testfile(name):
 
 class TestTemplateLanguage(unittest.TestCase):
 
+    engine = 'pyparsing'
+
     def setUp(self):
 
         def _test(*args, **kwargs):
@@ -19,7 +24,8 @@ class TestTemplateLanguage(unittest.TestCase):
                 args.append(body)
             return ', '.join(args)
 
-        self.lang = TemplateLanguage(tags={'t': _test}, development=True)
+        self.lang = TemplateLanguage(tags={'t': _test}, development=True,
+                                     engine=self.engine)
 
         self.unicodedata = []
         for line in _testfile("unicodedata.txt"):
@@ -85,5 +91,209 @@ class TestTemplateLanguage(unittest.TestCase):
         self.assertEqual(self.lang.parse(teststr), "hello nested world")
 
 
+    def test_compile(self):
+        template = self.lang.compile("hello {%t world%}{%t%}!{%endt%}")
+        self.assertEqual([type(s).__name__ for s in template.segments],
+                         ['str' if sys.version > '3' else 'unicode',
+                          'Tag', 'Tag'])
+        self.assertEqual(self.lang.render(template), "hello world!")
+
+        def _file(context={}):
+            return context.get('filename')
+
+        lang = TemplateLanguage(tags={'file': _file}, engine=self.engine)
+        template = lang.compile("{%file%}")
+        self.assertEqual(lang.render(template, filename='a'), "a")
+        self.assertEqual(lang.render(template, filename='b'), "b")
+
+
+    def test_compile_cache(self):
+        template = self.lang.compile("hello {%t world%}")
+        self.assertTrue(self.lang.compile("hello {%t world%}") is template)
+        self.lang.add_tag_with_name('u')(lambda *args, **kwargs: '')
+        self.assertFalse(self.lang.compile("hello {%t world%}") is template)
+
+
+    def test_contains_tags(self):
+        self.assertTrue(self.lang.contains_tags("hello {%t world%}"))
+        self.assertTrue(self.lang.contains_tags(b"hello {%t world%}"))
+        self.assertFalse(self.lang.contains_tags("hello world"))
+        self.assertFalse(self.lang.contains_tags(b"caf\xe9 {"))
+
+
+    def test_render_many(self):
+        calls = []
+
+        def _file(context={}):
+            calls.append('file')
+            return context.get('filename')
+
+        def _static(arg, context={}):
+            calls.append('static')
+            return arg
+
+        def _wrap(body='', context={}):
+            calls.append('wrap')
+            return "<" + body + ">"
+
+        lang = TemplateLanguage(tags={'file': _file, 'static': _static,
+                                      'wrap': _wrap},
+                                engine=self.engine, reparse=False)
+        template = "{% static a %} {% file %} {% wrap %}{% static b %}{% endwrap %}"
+        contexts = [{'filename': name} for name in ('x', 'y', 'x', 'z')]
+        expected = [lang.parse(template, **context) for context in contexts]
+        del calls[:]
+        self.assertEqual(list(lang.render_many(template, contexts)), expected)
+        self.assertEqual(calls.count('static'), 2)
+        self.assertEqual(calls.count('wrap'), 1)
+        self.assertEqual(calls.count('file'), 3)
+
+
+    def test_add_tag_after_parse(self):
+        self.assertEqual(self.lang.parse("{% t a %}{% u b %}"),
+                         "a{% u b %}")
+        self.lang.add_tag_with_name('u')(lambda arg, context={}: arg.upper())
+        self.assertEqual(self.lang.parse("{% t a %}{% u b %}"), "aB")
+        self.assertEqual(self.lang.parse("{% U b %}{% t %}x{% endT %}"), "Bx")
+
+
+    def test_expand_once(self):
+        def _echo(arg, context={}):
+            return arg
+
+        def _quote(arg, context={}):
+            return "{% echo " + arg + " %}"
+
+        def _template(arg, context={}):
+            return TemplateText("{% echo " + arg + " %}")
+
+        def _wrap(body='', context={}):
+            return body
+
+        tags = {'echo': _echo, 'quote': _quote, 'template': _template,
+                'wrap': _wrap}
+        lang = TemplateLanguage(tags=tags, engine=self.engine, reparse=False)
+        result = lang.parse("{% quote a %}")
+        self.assertEqual(result, "{% echo a %}")
+        result = lang.parse("{% template a %}")
+        self.assertEqual(result, "a")
+        result = lang.parse("{% wrap %}{% quote a %}{% endwrap %}")
+        self.assertEqual(result, "{% echo a %}")
+        result = lang.parse("{% wrap %}{% template a %}{% endwrap %}")
+        self.assertEqual(result, "a")
+
+
+    def test_generate(self):
+        def _template(arg, context={}):
+            return TemplateText("<{% t " + arg + " %}>")
+
+        lang = TemplateLanguage(tags={'t': lambda arg, context={}: arg, 
+                                      'template': _template},
+                                engine=self.engine, reparse=False)
+        teststr = "a {% t b %} c {% template d %} e"
+        self.assertEqual(list(lang.generate(teststr)),
+                         ["a ", "b", " c ", "<", "d", ">", " e"])
+
+        class Stream(object):
+            def __init__(self):
+                self.chunks = []
+            def write(self, chunk):
+                self.chunks.append(chunk)
+
+        stream = Stream()
+        lang.render_to(stream, lang.compile(teststr))
+        self.assertEqual("".join(stream.chunks), lang.parse(teststr))
+
+
+    def test_cycles(self):
+        def _loop(arg, context={}):
+            return TemplateText("{% loop " + arg + " %}")
+
+        def _deeper(arg, context={}):
+            return TemplateText("{% deeper x" + arg + " %}")
+
+        for reparse in (True, False):
+            lang = TemplateLanguage(tags={'loop': _loop, 'deeper': _deeper},
+                                    engine=self.engine, reparse=reparse,
+                                    max_depth=10)
+            with self.assertRaises(TagErrorException) as cm:
+                lang.parse("hello {% loop a %}")
+            self.assertEqual(cm.exception.msg, "tag 'loop a' expands to itself")
+            with self.assertRaises(TagErrorException) as cm:
+                lang.parse("hello {% deeper x %}")
+            self.assertEqual(cm.exception.msg,
+                             "tag 'deeper' is nested more than 10 levels deep")
+
+
+class TestScannerEngine(TestTemplateLanguage):
+
+    engine = 'scanner'
+
+    def setUp(self):
+        super(TestScannerEngine, self).setUp()
+
+        def _show(*args, **kwargs):
+            body = kwargs.get('body')
+            return repr((args, body))
+
+        tags = {'t': _show, 'a-b': _show, 'X': _show}
+        self.pylang = TemplateLanguage(tags=tags, development=True)
+        self.sclang = TemplateLanguage(tags=tags, development=True,
+                                       engine='scanner')
+
+
+    def assertSameResult(self, teststr):
+        self.assertEqual(self.sclang.parse(teststr), self.pylang.parse(teststr))
+
+
+    def test_packrat(self):
+        def _show(*args, **kwargs):
+            return repr((args, kwargs.get('body')))
+
+        lang = TemplateLanguage(tags={'t': _show, 'a-b': _show}, 
+                                development=True, packrat=True)
+        self.addCleanup(ParserElement.disable_memoization)
+        for teststr in ("{%t a%} x {%t b%} y {%endt%}", 
+                        "{% a-b 1 %}{%t%}{% enda-b %}{%a-bc%}"):
+            self.assertEqual(lang.parse(teststr), self.sclang.parse(teststr))
+            # packrat is only on while lang parses
+            self.assertFalse(ParserElement._packratEnabled)
+
+
+    def test_same_as_pyparsing(self):
+        self.assertSameResult("{% t %}  world \t{% endt %}")
+        self.assertSameResult("{%t a%} x {%t b%} y {%endt%}")
+        self.assertSameResult("{%t%}{%t%}{%x%}\t{%endt%} {%endt%}")
+        self.assertSameResult("{%T 'a\tb' \"c d\"e%}x{%ENDt%}")
+        self.assertSameResult("{%t%}x{%bad%}y{%endt%}")
+        self.assertSameResult("a%}{%t%}x%}y{%endt%}{%t")
+        self.assertSameResult("{% a-b 1 %}{%x%}{% enda-b %}{%a-bc%}")
+
+
+    def test_same_errors_as_pyparsing(self):
+        def _one(arg, context={}):
+            return arg
+
+        def _fail(context={}):
+            raise ValueError("oops")
+
+        for teststr in ("hello\n  {% one %}", "{%one 1%}\n{% fail %}"):
+            errors = []
+            for engine in ('pyparsing', 'scanner'):
+                lang = TemplateLanguage(tags={'one': _one, 'fail': _fail},
+                                        engine=engine)
+                with self.assertRaises(TagErrorException) as cm:
+                    lang.parse(teststr)
+                exc = cm.exception
+                errors.append((exc.msg, exc.loc, exc.lineno, exc.col))
+            self.assertEqual(errors[0], errors[1])
+
+
+    def test_many_tags(self):
+        teststr = "x {% t a %} " * 2000 + "{%t%}{%t b%}{%endt%}"
+        result = self.lang.parse(teststr)
+        self.assertEqual(result, "x a " * 2000 + "b")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from tags import utils
+from tests.helpers import SiteTestCase
+
+
+class TestPatterns(unittest.TestCase):
+
+    def test_matches_pattern(self):
+        self.assertTrue(utils.matches_pattern('**/*.html', 'index.html'))
+        self.assertTrue(utils.matches_pattern('**/*.html', 'a/b/index.html'))
+        self.assertFalse(utils.matches_pattern('**/*.html', 'a/style.css'))
+        self.assertTrue(utils.matches_pattern('_*/**', '_partials/nav.html'))
+        self.assertFalse(utils.matches_pattern('_*/**', '_partials'))
+        self.assertFalse(utils.matches_pattern('_*/**', 'a/_partials/b'))
+        self.assertTrue(utils.matches_pattern('a/**/b/*', 'a/b/c'))
+        self.assertTrue(utils.matches_pattern('a/**/b/*', 'a/x/y/b/c'))
+        self.assertFalse(utils.matches_pattern('a/*', 'a/b/c'))
+        self.assertTrue(utils.matches_pattern('[!_]?.txt', 'ab.txt'))
+        self.assertFalse(utils.matches_pattern('[!_]?.txt', '_b.txt'))
+        self.assertFalse(utils.matches_pattern('a?b', 'a/b'))
+
+
+    def test_multiple_patterns(self):
+        pattern = utils.compile_pattern(['_*/**', 'node_modules/**'])
+        self.assertTrue(utils.compile_pattern(pattern.patterns) is pattern)
+        self.assertTrue(pattern.matches('node_modules/a/b.js'))
+        self.assertTrue(pattern.matches('_site/index.html'))
+        self.assertFalse(pattern.matches('index.html'))
+        self.assertTrue(pattern.matches_folder('node_modules'))
+        self.assertTrue(pattern.matches_folder('_site'))
+        self.assertFalse(pattern.matches_folder('a/node_modules'))
+        self.assertFalse(utils.compile_pattern('**/*.html').matches_folder('a'))
+        self.assertTrue(utils.compile_pattern('**').matches_folder('a'))
+
+
+    def test_walk_folder(self):
+        root = tempfile.mkdtemp()
+        try:
+            for path in ('index.html', '_partials/nav.html', 'css/style.css',
+                         'node_modules/a/b.js'):
+                with utils.open_file(os.path.join(root, path), 'w', 
+                                     create_dir=True) as afile:
+                    afile.write(path)
+            exclude = utils.compile_pattern(['_*/**', 'node_modules/**'])
+            self.assertEqual(sorted(utils.walk_folder(root, exclude=exclude)),
+                             ['css/style.css', 'index.html'])
+        finally:
+            shutil.rmtree(root)
+
+
+    def test_scan_folder(self):
+        root = tempfile.mkdtemp()
+        try:
+            for path in ('index.html', '_partials/nav.html', 'css/style.css',
+                         'css/fonts/a.woff'):
+                with utils.open_file(os.path.join(root, path), 'w', 
+                                     create_dir=True) as afile:
+                    afile.write(path)
+            if hasattr(os, 'symlink'):
+                os.symlink(os.path.join(root, 'css'), 
+                           os.path.join(root, 'link'))
+            exclude = utils.compile_pattern('_*/**')
+            entries = list(utils.scan_folder(root, exclude=exclude))
+            self.assertEqual(sorted(entry.name for entry in entries),
+                             ['css/fonts/a.woff', 'css/style.css', 
+                              'index.html'])
+            for entry in entries:
+                self.assertEqual(entry.path, os.path.join(root, entry.name))
+                self.assertEqual(entry.signature(), 
+                                 utils.file_signature(entry.path))
+                self.assertTrue(entry.stat() is entry.stat())
+        finally:
+            shutil.rmtree(root)
+
+
+class TestSyncFile(SiteTestCase):
+
+    def setUp(self):
+        SiteTestCase.setUp(self)
+        self.src = os.path.join(self.root, 'src.png')
+        self.dst = os.path.join(self.root, 'out', 'dst.png')
+        self.write(self.src, "image")
+
+
+    def test_skip_unchanged(self):
+        self.assertEqual(utils.sync_file(self.src, self.dst), (5, 0))
+        self.assertEqual(self.read(self.dst), "image")
+        self.write(self.dst, "stale")
+        shutil.copystat(self.src, self.dst)
+        self.assertEqual(utils.sync_file(self.src, self.dst), (0, 5))
+        self.assertEqual(self.read(self.dst), "stale")
+        self.assertEqual(utils.sync_file(self.src, self.dst, checksum=True),
+                         (5, 0))
+        self.assertEqual(self.read(self.dst), "image")
+        self.assertEqual(utils.sync_file(self.src, self.dst, checksum=True),
+                         (0, 5))
+
+
+    def test_srcstat(self):
+        srcstat = os.stat(self.src)
+        self.assertEqual(utils.sync_file(self.src, self.dst, srcstat=srcstat),
+                         (5, 0))
+        self.assertEqual(os.stat(self.dst).st_mtime, srcstat.st_mtime)
+        self.assertEqual(utils.sync_file(self.src, self.dst, srcstat=srcstat),
+                         (0, 5))
+
+
+    def test_link(self):
+        self.assertEqual(utils.sync_file(self.src, self.dst, link=True), 
+                         (0, 5))
+        self.assertTrue(os.path.samefile(self.src, self.dst))
+        self.write(self.src, "new image")
+        self.assertEqual(utils.sync_file(self.src, self.dst), (0, 9))
+        os.remove(self.src)
+        self.write(self.src, "image")
+        self.assertEqual(utils.sync_file(self.src, self.dst), (5, 0))
+        self.assertEqual(self.read(self.dst), "image")
+
+
+if __name__ == '__main__':
+    unittest.main()